@@ -3,6 +3,7 @@ import logging
 import os
 import time
 import datetime
+import urllib.parse
 
 from slack_bolt import App
 from slack_bolt.adapter.aws_lambda import SlackRequestHandler
@@ -10,25 +11,22 @@ import aws_lambda_wsgi
 from bottle import Bottle, request, response
 
 import boto3
+import botocore.exceptions
+
+import ssm_cache
+import webhook_queue
 
-# process_before_response must be True when running on FaaS
-ssm_client = boto3.client("ssm")
 sfn_client = boto3.client("stepfunctions")
+s3_client = boto3.client("s3")
+private_bucket_name = os.environ["S3_PRIVATE"]
+unfurl_cache_ttl = int(os.environ.get("UNFURL_CACHE_TTL", "86400"))
 
 signing_secret_name = os.environ["SSM_SLACK_SIGNING_SECRET"]
 token_name = os.environ["SSM_SLACK_BOT_TOKEN"]
-ssm_response = ssm_client.get_parameters(Names=[signing_secret_name, token_name])
-for param in ssm_response["Parameters"]:
-    if param["Name"] == signing_secret_name:
-        signing_secret = param["Value"]
-    elif param["Name"] == token_name:
-        token = param["Value"]
-if not token or not signing_secret:
-    raise Exception("can't retrieve ssm")
-
-
-slack_app = App(
-    signing_secret=signing_secret, token=token, process_before_response=True
+slack_secrets = ssm_cache.SecretsCache(
+    [signing_secret_name, token_name],
+    ttl=int(os.environ.get("SSM_CACHE_TTL", "300")),
+    cache_path=os.environ.get("SSM_CACHE_PATH"),
 )
 
 
@@ -58,28 +56,79 @@ def process_request(respond, body, logger):
     respond(f"Completed! (task: {title})")
 
 
-slack_app.command(command)(
-    ack=respond_to_slack_within_3_seconds, lazy=[process_request]
-)
-
-
 def fast_ack(ack, logger):
     logger.info("unfurl_kibela fast_ack")
     ack()
 
 
+def get_unfurl_cache_key(url):
+    # wordcloud-app側と同じキーを使う
+    # /notes/N と /@user/N は同じ記事なので、末尾の記事番号があればそれで引く
+    path = urllib.parse.urlparse(url).path.strip("/")
+    number = path.rsplit("/", 1)[-1]
+    if number.isdigit():
+        return f"unfurl/notes/{number}.json"
+    return f"unfurl/{path}.json"
+
+
+def get_cached_unfurl(url):
+    # 記事が更新されるとkibela_webhookでキャッシュが無効の印に置き換わる
+    # キャッシュが読めなくてもステートマシンでunfurlする
+    try:
+        ret = s3_client.get_object(
+            Bucket=private_bucket_name, Key=get_unfurl_cache_key(url)
+        )
+        cache = json.loads(ret["Body"].read())
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            logging.warning(f"unfurl cache read error [{url}]: {e}")
+        return None
+    except (botocore.exceptions.BotoCoreError, ValueError) as e:
+        logging.warning(f"unfurl cache read error [{url}]: {e}")
+        return None
+    if not isinstance(cache, dict) or "attachement" not in cache:
+        return None
+    # いつの内容か分からないキャッシュは使わない
+    if cache.get("contentUpdatedAt") is None:
+        return None
+    if time.time() - cache.get("cachedAt", 0) > unfurl_cache_ttl:
+        return None
+    return cache["attachement"]
+
+
+def invalidate_cached_unfurl(url):
+    # 消すだけだと、更新前に始まったunfurlが古い内容を書き戻してしまう
+    # 無効にした時刻を残し、それより前に取得した記事はput_unfurl_cacheが書かない
+    body = {"url": url, "invalidatedAt": time.time()}
+    s3_client.put_object(
+        Bucket=private_bucket_name,
+        Key=get_unfurl_cache_key(url),
+        Body=json.dumps(body).encode("utf-8"),
+    )
+
+
 def unfurl_kibela(logger, event, client):
     logger.info(f"unfurl_kibela lazy {event} {client}")
-    response = sfn_client.start_sync_execution(
-        stateMachineArn=os.environ["UNFURL_STATEMACHINE_ARN"],
-        input=json.dumps({"links": event["links"]}),
-    )
-    logger.info(f"Unfurl Response: {response}")
-    output = json.loads(response["output"])
-    logger.info(f"{output=}")
-    unfurl_dict = dict(
-        map(lambda x: (x["Payload"]["url"], x["Payload"]["attachement"]), output)
-    )
+    unfurl_dict = {}
+    links = []
+    for link in event["links"]:
+        attachement = get_cached_unfurl(link["url"])
+        if attachement is None:
+            links.append(link)
+        else:
+            unfurl_dict[link["url"]] = attachement
+    logger.info(f"unfurl cache hit: {len(unfurl_dict)} miss: {len(links)}")
+    if links:
+        response = sfn_client.start_sync_execution(
+            stateMachineArn=os.environ["UNFURL_STATEMACHINE_ARN"],
+            input=json.dumps({"links": links}),
+        )
+        logger.info(f"Unfurl Response: {response}")
+        output = json.loads(response["output"])
+        logger.info(f"{output=}")
+        unfurl_dict.update(
+            map(lambda x: (x["Payload"]["url"], x["Payload"]["attachement"]), output)
+        )
     logger.info(f"sending unfurl. {unfurl_dict}")
     client.chat_unfurl(
         channel=event["channel"],
@@ -89,14 +138,82 @@ def unfurl_kibela(logger, event, client):
     logger.info(f"unfurl done. {unfurl_dict}")
 
 
-slack_app.event("link_shared")(ack=fast_ack, lazy=[unfurl_kibela])
+def create_slack_handler(signing_secret, token):
+    # process_before_response must be True when running on FaaS
+    slack_app = App(
+        signing_secret=signing_secret, token=token, process_before_response=True
+    )
+    slack_app.command(command)(
+        ack=respond_to_slack_within_3_seconds, lazy=[process_request]
+    )
+    slack_app.event("link_shared")(ack=fast_ack, lazy=[unfurl_kibela])
+    return SlackRequestHandler(app=slack_app)
+
+
+_slack_handler = {"secrets": None, "handler": None}
+
+
+def get_slack_handler():
+    # SSMの値が変わっていたらAppを作り直す
+    secrets = (slack_secrets.get(signing_secret_name), slack_secrets.get(token_name))
+    if _slack_handler["secrets"] != secrets:
+        if _slack_handler["secrets"] is not None:
+            logging.info("slack secrets updated. recreate app.")
+        _slack_handler["handler"] = create_slack_handler(*secrets)
+        _slack_handler["secrets"] = secrets
+    return _slack_handler["handler"]
+
+
+class UpdateExecutionRunning(Exception):
+    pass
+
+
+def update_execution_running():
+    # 全件の実行(enumerate)もTFとdf.jsonを書き換えるので、動いていれば待つ
+    arns = [
+        os.environ["UPDATE_STATEMACHINE_ARN"],
+        os.environ.get("ENUMERATE_STATEMACHINE_ARN"),
+    ]
+    for arn in filter(None, arns):
+        ret = sfn_client.list_executions(
+            stateMachineArn=arn, statusFilter="RUNNING", maxResults=1
+        )
+        if ret["executions"]:
+            return True
+    return False
+
+
+def start_update_execution(urls):
+    # 更新の実行はdf.jsonを差分で書き換えるので、全件の実行とも重ならないようにする
+    # SQSのコンシューマは予約同時実行数1なので確認と開始の間に割り込まれない
+    if update_execution_running():
+        logging.info(f"update execution is running. retry later: {len(urls)} notes")
+        return False
+    sfn_client.start_execution(
+        stateMachineArn=os.environ["UPDATE_STATEMACHINE_ARN"],
+        input=json.dumps({"urls": urls}),
+    )
+    logging.info(f"start update execution: {len(urls)} notes")
+    return True
+
+
+def create_update_queue():
+    queue_url = os.environ.get("WEBHOOK_QUEUE_URL")
+    if queue_url:
+        return webhook_queue.SqsQueue(queue_url, boto3.client("sqs"))
+    # SQSが無いローカルではプロセス内でまとめる
+    return webhook_queue.InMemoryQueue(
+        float(os.environ.get("WEBHOOK_WINDOW", "30")), start_update_execution
+    )
+
+
+update_queue = create_update_queue()
+
 
 SlackRequestHandler.clear_all_log_handlers()
 # logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG)
 logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
 
-slack_handler = SlackRequestHandler(app=slack_app)
-
 bottle_app = Bottle()
 
 
@@ -112,17 +229,23 @@ def kibela_webhook():
     if req["resource_type"] in ["blog", "wiki"]:
         action = req["action"]
         url = req[req["resource_type"]]["url"]
-        response = sfn_client.start_execution(
-            stateMachineArn=os.environ["UPDATE_STATEMACHINE_ARN"],
-            input=json.dumps({"url": url}),
-        )
+        invalidate_cached_unfurl(url)
+        # 続けて届いた更新はキューでまとめてから1回の実行で処理する
+        update_queue.send(url)
     return {"ok": True}
 
 
 def handler(event, context):
     logging.info(f"Event: {event}")
+    if webhook_queue.is_sqs_event(event):
+        urls = webhook_queue.urls_from_sqs_event(event)
+        logging.info(f"webhooks: {len(event['Records'])} notes: {len(urls)}")
+        if not start_update_execution(urls):
+            # 失敗にしてメッセージをキューに戻し、可視性タイムアウト後にやり直す
+            raise UpdateExecutionRunning(f"{len(urls)} notes")
+        return {"ok": True}
     if "path" in event and event["path"].startswith("/slack/"):
-        return slack_handler.handle(event, context)
+        return get_slack_handler().handle(event, context)
     else:
         res = aws_lambda_wsgi.response(bottle_app, event, context)
         logging.info(f"{res=}")
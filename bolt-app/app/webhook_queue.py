@@ -0,0 +1,74 @@
+"""Kibelaのwebhookで届いた記事URLをまとめてから更新を始めるためのキュー
+
+保存を繰り返したり一括インポートしたりするとwebhookが続けて届くので、
+記事ごとに更新のステートマシンを起動せず、キューに入れて一定時間ためる。
+ためたURLは重複を除いてからまとめて1回の実行に渡す(IDFの更新も1回で済む)。
+
+SqsQueue
+    SQSに送る。配信遅延とLambdaのバッチウィンドウの間に届いたURLが
+    1回のイベントにまとまる。コンシューマは予約同時実行数1で、更新の実行中は
+    失敗してメッセージをキューに戻すので、更新の実行は同時に1つだけになる。
+InMemoryQueue
+    SQSが無いローカル用。プロセス内にためてwindow秒後にflushする。
+"""
+import json
+import threading
+import time
+
+
+def coalesce_urls(urls):
+    # 順番を保ったまま重複を除く
+    return list(dict.fromkeys(urls))
+
+
+def urls_from_sqs_event(event):
+    return coalesce_urls(
+        json.loads(record["body"])["url"] for record in event["Records"]
+    )
+
+
+def is_sqs_event(event):
+    records = event.get("Records")
+    return bool(records) and records[0].get("eventSource") == "aws:sqs"
+
+
+class SqsQueue:
+    def __init__(self, queue_url, client):
+        self.queue_url = queue_url
+        self.client = client
+
+    def send(self, url):
+        self.client.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps({"url": url, "receivedAt": time.time()}),
+        )
+
+
+class InMemoryQueue:
+    def __init__(self, window, flush):
+        # flush: (urls) -> bool Falseならやり直す
+        self.window = window
+        self.flush_urls = flush
+        self.urls = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def send(self, url):
+        with self.lock:
+            self.urls.append(url)
+            if self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            urls = coalesce_urls(self.urls)
+            self.urls = []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if urls and self.flush_urls(urls) is False:
+            # 更新を始められなかったら戻してwindow秒後にやり直す
+            for url in urls:
+                self.send(url)
@@ -6,6 +6,7 @@ import aws_cdk.aws_apigateway as apigateway
 import aws_cdk.aws_iam as iam
 import aws_cdk.aws_ssm as ssm
 import aws_cdk.aws_s3 as s3
+import aws_cdk.aws_sqs as sqs
 import aws_cdk.aws_stepfunctions as sfn
 import aws_cdk.aws_stepfunctions_tasks as tasks
 import aws_cdk.aws_logs as logs
@@ -15,58 +16,137 @@ import json
 
 class CdkStack(core.Stack):
     def create_enumerate_statemachine(self):
+        # 記事一覧はS3上のチャンクに置き、ステートにはキーだけを流す
         enumerate_job = tasks.LambdaInvoke(
             self,
             "Enumerate Notes Job",
             lambda_function=self.step_lambda,
-            payload=sfn.TaskInput.from_object({"action": "enumerate_notes"}),
+            payload=sfn.TaskInput.from_object(
+                {"action": "enumerate_notes", "chunk_size": 100, "use_manifest": True}
+            ),
+            output_path="$.Payload",
         )
         get_tf_job = tasks.LambdaInvoke(
             self,
-            "Get Text Frequency Job",
+            "Get Text Frequency Batch Job",
+            lambda_function=self.step_lambda,
+            payload=sfn.TaskInput.from_object(
+                {"action": "update_tf_batch", "chunk_key.$": "$"}
+            ),
+        )
+        map_job = sfn.Map(
+            self,
+            "Notes Map",
+            items_path="$.chunk_keys",
+            max_concurrency=8,
+            result_path=sfn.JsonPath.DISCARD,
+        )
+        compact_job = tasks.LambdaInvoke(
+            self,
+            "Compact Text Frequency Shards Job",
+            lambda_function=self.step_lambda,
+            payload=sfn.TaskInput.from_object({"action": "compact_tf_shards"}),
+            result_path=sfn.JsonPath.DISCARD,
+        )
+        # IDFはmap-reduceで計算する
+        plan_idf_job = tasks.LambdaInvoke(
+            self,
+            "Plan Inter Document Frequency Job",
             lambda_function=self.step_lambda,
             payload=sfn.TaskInput.from_object(
                 {
-                    "action": "update_tf",
-                    "id.$": "$.id",
-                    "contentUpdatedAt.$": "$.contentUpdatedAt",
-                    "isArchived.$": "$.isArchived",
+                    "action": "plan_idf",
+                    "num_units": 32,
+                    "idfOutdated.$": "$.idfOutdated",
                 }
             ),
-            output_path="$.Payload"
+            payload_response_only=True,
+            result_path="$.idf",
         )
-        map_job = sfn.Map(
-            self, "Notes Map", items_path="$.Payload.id_list", max_concurrency=8
+        map_idf_job = tasks.LambdaInvoke(
+            self,
+            "Map Inter Document Frequency Job",
+            lambda_function=self.step_lambda,
+            payload=sfn.TaskInput.from_object(
+                {
+                    "action": "map_idf",
+                    "prefix.$": "$.prefix",
+                    "unit.$": "$.unit",
+                }
+            ),
+        )
+        # 読めないTFがあると部分結果を書かずに失敗するのでやり直す
+        map_idf_job.add_retry(
+            errors=["States.TaskFailed"],
+            interval=core.Duration.seconds(10),
+            max_attempts=2,
+        )
+        map_idf_units_job = sfn.Map(
+            self,
+            "Inter Document Frequency Map",
+            items_path="$.idf.units",
+            parameters={
+                "prefix.$": "$.idf.prefix",
+                "unit.$": "$$.Map.Item.Value",
+            },
+            max_concurrency=32,
+            result_path=sfn.JsonPath.DISCARD,
         )
-        get_idf_job = tasks.LambdaInvoke(
+        reduce_idf_job = tasks.LambdaInvoke(
             self,
-            "Get Inter Document Frequency Job",
+            "Reduce Inter Document Frequency Job",
             lambda_function=self.step_lambda,
             payload=sfn.TaskInput.from_object(
-                {"action": "update_idf", "notes.$": "$"}
+                {"action": "reduce_idf", "prefix.$": "$.idf.prefix"}
             ),
+            result_path=sfn.JsonPath.DISCARD,
         )
         map_tfidf_job = sfn.Map(
-            self, "TF*IDF Notes Map", items_path="$.Payload.notes", max_concurrency=100
+            self,
+            "TF*IDF Chunks Map",
+            items_path="$.chunk_keys",
+            max_concurrency=8,
+            result_path=sfn.JsonPath.DISCARD,
         )
         get_tfidf_job = tasks.LambdaInvoke(
             self,
-            "Get TF*IDF WordCloud Image Job",
+            "Get TF*IDF WordCloud Image Batch Job",
+            lambda_function=self.step_lambda,
+            payload=sfn.TaskInput.from_object(
+                {"action": "update_tfidf_png_batch", "chunk_key.$": "$"}
+            ),
+        )
+        related_job = tasks.LambdaInvoke(
+            self,
+            "Update Related Notes Job",
             lambda_function=self.step_lambda,
             payload=sfn.TaskInput.from_object(
                 {
-                    "action": "update_tfidf_png",
-                    "id.$": "$.id",
-                    "contentUpdatedAt.$": "$.contentUpdatedAt",
-                    "isArchived.$": "$.isArchived",
+                    "action": "update_related_notes",
+                    "chunk_keys.$": "$.chunk_keys",
+                    "idfOutdated.$": "$.idfOutdated",
                 }
             ),
+            result_path=sfn.JsonPath.DISCARD,
+        )
+        update_manifest_job = tasks.LambdaInvoke(
+            self,
+            "Update Manifest Job",
+            lambda_function=self.step_lambda,
+            payload=sfn.TaskInput.from_object(
+                {"action": "update_manifest", "chunk_keys.$": "$.chunk_keys"}
+            ),
         )
 
         definition = (
             enumerate_job.next(map_job.iterator(get_tf_job))
-            .next(get_idf_job)
+            .next(compact_job)
+            .next(plan_idf_job)
+            .next(map_idf_units_job.iterator(map_idf_job))
+            .next(reduce_idf_job)
             .next(map_tfidf_job.iterator(get_tfidf_job))
+            .next(related_job)
+            .next(update_manifest_job)
         )
         self.enumerate_statemachine = sfn.StateMachine(
             self,
@@ -77,63 +157,96 @@ class CdkStack(core.Stack):
 
     def create_update_statemachine(self):
         # update Workflow
-        get_note_job = tasks.LambdaInvoke(
+        # webhookでまとめて届いた記事URLをチャンクにし、IDFは1回だけ更新する
+        resolve_job = tasks.LambdaInvoke(
             self,
-            "Get Note Job",
+            "Resolve Note URLs Job",
             lambda_function=self.step_lambda,
             payload=sfn.TaskInput.from_object(
-                {"action": "get_note_from_url", "url.$": "$.url"}
+                {"action": "enumerate_urls", "urls.$": "$.urls", "chunk_size": 100}
             ),
+            output_path="$.Payload",
         )
         get_tf_job_update = tasks.LambdaInvoke(
             self,
-            "Get Text Frequency Job for Update",
+            "Get Text Frequency Batch Job for Update",
             lambda_function=self.step_lambda,
             payload=sfn.TaskInput.from_object(
-                {
-                    "action": "update_tf",
-                    "id.$": "$.Payload.id",
-                    "contentUpdatedAt.$": "$.Payload.contentUpdatedAt",
-                    "isArchived.$": "$.Payload.isArchived",
-                }
+                {"action": "update_tf_batch", "incremental": True, "chunk_key.$": "$"}
             ),
         )
+        # df.jsonを差分で更新するのでチャンクは1つずつ処理する
+        map_tf_job_update = sfn.Map(
+            self,
+            "Notes Map for Update",
+            items_path="$.chunk_keys",
+            max_concurrency=1,
+            result_path=sfn.JsonPath.DISCARD,
+        )
         get_idf_job_update = tasks.LambdaInvoke(
             self,
             "Get Inter Document Frequency Job for Update",
             lambda_function=self.step_lambda,
             payload=sfn.TaskInput.from_object(
-                {
-                    "action": "update_idf",
-                    "id.$": "$.Payload.id",
-                    "contentUpdatedAt.$": "$.Payload.contentUpdatedAt",
-                    "isArchived.$": "$.Payload.isArchived",
-                }
+                {"action": "update_idf", "idfOutdated.$": "$.idfOutdated"}
             ),
+            result_path=sfn.JsonPath.DISCARD,
+        )
+        get_idf_job_update.add_retry(
+            errors=["States.TaskFailed"],
+            interval=core.Duration.seconds(10),
+            max_attempts=2,
         )
         get_tfidf_job_update = tasks.LambdaInvoke(
             self,
-            "Get TF*IDF WordCloud Image Job for Update",
+            "Get TF*IDF WordCloud Image Batch Job for Update",
+            lambda_function=self.step_lambda,
+            payload=sfn.TaskInput.from_object(
+                {"action": "update_tfidf_png_batch", "chunk_key.$": "$"}
+            ),
+        )
+        map_tfidf_job_update = sfn.Map(
+            self,
+            "TF*IDF Chunks Map for Update",
+            items_path="$.chunk_keys",
+            max_concurrency=8,
+            result_path=sfn.JsonPath.DISCARD,
+        )
+        related_job_update = tasks.LambdaInvoke(
+            self,
+            "Update Related Notes Job for Update",
             lambda_function=self.step_lambda,
             payload=sfn.TaskInput.from_object(
                 {
-                    "action": "update_tfidf_png",
-                    "id.$": "$.Payload.id",
-                    "contentUpdatedAt.$": "$.Payload.contentUpdatedAt",
-                    "isArchived.$": "$.Payload.isArchived",
+                    "action": "update_related_notes",
+                    "incremental": True,
+                    "chunk_keys.$": "$.chunk_keys",
                 }
             ),
+            result_path=sfn.JsonPath.DISCARD,
+        )
+        update_manifest_job_update = tasks.LambdaInvoke(
+            self,
+            "Update Manifest Job for Update",
+            lambda_function=self.step_lambda,
+            payload=sfn.TaskInput.from_object(
+                {"action": "update_manifest", "chunk_keys.$": "$.chunk_keys"}
+            ),
         )
 
-        update_note_definition = get_note_job.next(
-            get_tf_job_update.next(get_idf_job_update.next(get_tfidf_job_update))
+        update_note_definition = (
+            resolve_job.next(map_tf_job_update.iterator(get_tf_job_update))
+            .next(get_idf_job_update)
+            .next(map_tfidf_job_update.iterator(get_tfidf_job_update))
+            .next(related_job_update)
+            .next(update_manifest_job_update)
         )
 
         self.update_note_statemachine = sfn.StateMachine(
             self,
             "UpdateNoteStateMachine",
             definition=update_note_definition,
-            timeout=core.Duration.minutes(10),
+            timeout=core.Duration.minutes(30),
         )
 
     def create_unfurl_statemachine(self):
@@ -142,34 +255,27 @@ class CdkStack(core.Stack):
             self,
             "Get Note Job for Unfurl",
             lambda_function=self.step_lambda,
-            payload=sfn.TaskInput.from_object(
-                {"action": "get_note_from_url", "url.$": "$.url"}
-            ),
-        )
-        get_tf_job = tasks.LambdaInvoke(
-            self,
-            "Get Text Frequency Job for Unfurl",
-            lambda_function=self.step_lambda,
             payload=sfn.TaskInput.from_object(
                 {
-                    "action": "update_tf",
-                    "id.$": "$.Payload.id",
-                    "url.$": "$.Payload.url",
-                    "contentUpdatedAt.$": "$.Payload.contentUpdatedAt",
-                    "isArchived.$": "$.Payload.isArchived",
+                    "action": "get_note_from_url",
+                    "with_detail": True,
+                    "url.$": "$.url",
                 }
             ),
         )
-        get_idf_job = tasks.LambdaInvoke(
+        # TFとdf.jsonは更新の実行だけが書くので、ここではTFを保存せずに描画する
+        get_tfidf_from_note_job = tasks.LambdaInvoke(
             self,
-            "Get Inter Document Frequency Job for Unfurl",
+            "Get TF*IDF WordCloud Image from Note Job for Unfurl",
             lambda_function=self.step_lambda,
             payload=sfn.TaskInput.from_object(
                 {
-                    "action": "update_idf",
+                    "action": "update_tfidf_png_from_note",
                     "id.$": "$.Payload.id",
                     "url.$": "$.Payload.url",
+                    "note.$": "$.Payload.note",
                     "contentUpdatedAt.$": "$.Payload.contentUpdatedAt",
+                    "fetchedAt.$": "$.Payload.fetchedAt",
                     "isArchived.$": "$.Payload.isArchived",
                 }
             ),
@@ -183,7 +289,9 @@ class CdkStack(core.Stack):
                     "action": "update_tfidf_png",
                     "id.$": "$.Payload.id",
                     "url.$": "$.Payload.url",
+                    "note.$": "$.Payload.note",
                     "contentUpdatedAt.$": "$.Payload.contentUpdatedAt",
+                    "fetchedAt.$": "$.Payload.fetchedAt",
                     "isArchived.$": "$.Payload.isArchived",
                 }
             ),
@@ -197,11 +305,15 @@ class CdkStack(core.Stack):
                     "action": "unfurl",
                     "id.$": "$.Payload.id",
                     "url.$": "$.Payload.url",
+                    "note.$": "$.Payload.note",
+                    "contentUpdatedAt.$": "$.Payload.contentUpdatedAt",
+                    "fetchedAt.$": "$.Payload.fetchedAt",
                 }
             ),
         )
 
-        get_tf_job.next(get_idf_job.next(get_tfidf_job.next(unfurl_job)))
+        get_tfidf_from_note_job.next(unfurl_job)
+        get_tfidf_job.next(unfurl_job)
 
         choice_job = sfn.Choice(self, "Check for Update")
         choice_job.when(
@@ -221,7 +333,7 @@ class CdkStack(core.Stack):
             ),
             get_tfidf_job,
         ).otherwise(
-            get_tf_job
+            get_tfidf_from_note_job
         )
 
         unfurl_definition = map_job.iterator(get_note_job.next(choice_job))
@@ -270,6 +382,7 @@ class CdkStack(core.Stack):
                 "SSM_KIBELA_TOKEN": self.ssm_kibela_token.parameter_name,
                 "S3_PUBLIC": self.public_s3.bucket_name,
                 "S3_PRIVATE": self.private_s3.bucket_name,
+                "TF_SHARDS": "16",
             },
             log_retention=logs.RetentionDays.FIVE_DAYS,
             timeout=core.Duration.seconds(600),
@@ -280,6 +393,15 @@ class CdkStack(core.Stack):
         self.create_update_statemachine()
         self.create_unfurl_statemachine()
 
+        # webhookを配信遅延とバッチウィンドウの間ためてから更新を始める
+        # 更新の実行中に受け取ったバッチは失敗にして可視性タイムアウト後にやり直す
+        self.webhook_queue = sqs.Queue(
+            self,
+            "KibelaWebhookQueue",
+            delivery_delay=core.Duration.seconds(30),
+            visibility_timeout=core.Duration.seconds(180),
+        )
+
         self.bolt_lambda = PythonFunction(
             self,
             "BoltFunction",
@@ -298,10 +420,38 @@ class CdkStack(core.Stack):
                 "SSM_SLACK_BOT_TOKEN": self.ssm_bot_token.parameter_name,
                 "UPDATE_STATEMACHINE_ARN": self.update_note_statemachine.state_machine_arn,
                 "UNFURL_STATEMACHINE_ARN": self.unfurl_statemachine.state_machine_arn,
+                "S3_PRIVATE": self.private_s3.bucket_name,
+                "WEBHOOK_QUEUE_URL": self.webhook_queue.queue_url,
             },
             log_retention=logs.RetentionDays.FIVE_DAYS,
             timeout=core.Duration.seconds(600),
         )
+        # 更新の実行が重ならないよう、キューは予約同時実行数1の関数で読む
+        self.webhook_consumer_lambda = PythonFunction(
+            self,
+            "WebhookConsumerFunction",
+            entry=path.join(path.dirname(__name__), "../bolt-app/app"),
+            index="app.py",
+            handler="handler",
+            runtime=lambda_.Runtime.PYTHON_3_8,
+            environment={
+                "SSM_SLACK_SIGNING_SECRET": self.ssm_signing_secret.parameter_name,
+                "SSM_SLACK_BOT_TOKEN": self.ssm_bot_token.parameter_name,
+                "UPDATE_STATEMACHINE_ARN": self.update_note_statemachine.state_machine_arn,
+                "ENUMERATE_STATEMACHINE_ARN": self.enumerate_statemachine.state_machine_arn,
+                "S3_PRIVATE": self.private_s3.bucket_name,
+                "WEBHOOK_QUEUE_URL": self.webhook_queue.queue_url,
+            },
+            log_retention=logs.RetentionDays.FIVE_DAYS,
+            timeout=core.Duration.seconds(30),
+            reserved_concurrent_executions=1,
+        )
+        self.webhook_consumer_lambda.add_event_source_mapping(
+            "KibelaWebhookQueueMapping",
+            event_source_arn=self.webhook_queue.queue_arn,
+            batch_size=100,
+            max_batching_window=core.Duration.seconds(60),
+        )
         self.apigw = apigateway.LambdaRestApi(
             self, "BoltRestGw", handler=self.bolt_lambda
         )
@@ -318,8 +468,22 @@ class CdkStack(core.Stack):
         )
         self.ssm_signing_secret.grant_read(self.bolt_lambda)
         self.ssm_bot_token.grant_read(self.bolt_lambda)
+        self.private_s3.grant_read(self.bolt_lambda, "unfurl/*")
+        # webhookでキャッシュを無効の印に置き換える
+        self.private_s3.grant_put(self.bolt_lambda, "unfurl/*")
 
         self.update_note_statemachine.grant_start_execution(self.bolt_lambda)
+        self.webhook_queue.grant_send_messages(self.bolt_lambda)
+        self.webhook_queue.grant_consume_messages(self.webhook_consumer_lambda)
+        self.update_note_statemachine.grant_start_execution(
+            self.webhook_consumer_lambda
+        )
+        self.update_note_statemachine.grant(
+            self.webhook_consumer_lambda, "states:ListExecutions"
+        )
+        self.enumerate_statemachine.grant(
+            self.webhook_consumer_lambda, "states:ListExecutions"
+        )
         self.unfurl_statemachine.grant(self.bolt_lambda, "states:StartSyncExecution")
 
         # Rule(self, "KeepWarmEvents",
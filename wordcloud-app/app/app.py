@@ -1,28 +1,108 @@
+import time
+
+_import_start = time.perf_counter()
+
 import datetime
 import json
 import logging
-import math
 
 logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
 import os
 import re
 import io
-from collections import Counter
-import time
-import concurrent
+from collections import Counter, defaultdict
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import importlib
+import multiprocessing
+import multiprocessing.connection
+import threading
+import traceback
+import urllib.parse
 
 import botocore
 import boto3
-from gql import Client, gql
-from gql.transport.requests import RequestsHTTPTransport
-from wordcloud import WordCloud
-from konoha import WordTokenizer
 
-import html_text
+import metrics
+import ssm_cache
+
+# LOG_LEVEL=DEBUG ならイベントやGraphQLの結果をそのまま出す
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+action_metrics = metrics.Metrics(
+    os.environ.get("METRICS_NAMESPACE", "KibelaWordCloud"),
+    enabled=os.environ.get("METRICS", "1") == "1",
+    sink_path=os.environ.get("METRICS_JSON_PATH"),
+)
+
+# STARTUP_PROFILE=1 ならモジュールの読み込みやクライアントの初期化時間を出す
+profile_startup = os.environ.get("STARTUP_PROFILE", "") == "1"
+startup_profile = {}
+_lazy_lock = threading.RLock()
+
+
+def record_startup(name, start):
+    startup_profile[name] = time.perf_counter() - start
+    if profile_startup:
+        logger.info(f"startup {name}: {startup_profile[name]:.3f}s")
+
+
+class LazyModule:
+    """属性に初めて触れたときにimportするモジュール
+
+    actionごとに必要なモジュールだけを読み込んでコールドスタートを短くする。
+    """
+
+    def __init__(self, name, on_load=None):
+        self._name = name
+        self._on_load = on_load
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with _lazy_lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    if self._on_load is not None:
+                        self._on_load(module)
+                    record_startup(f"import {self._name}", start)
+                    self._module = module
+        return getattr(self._module, attr)
+
+
+class LazyObject:
+    """属性に初めて触れたときにfactoryで作るオブジェクト(クライアントなど)"""
+
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._object = None
+
+    def __getattr__(self, attr):
+        if self._object is None:
+            with _lazy_lock:
+                if self._object is None:
+                    start = time.perf_counter()
+                    obj = self._factory()
+                    record_startup(f"init {self._name}", start)
+                    self._object = obj
+        return getattr(self._object, attr)
+
 
-html_text.cleaner.kill_tags = ["code", "blockquote"]
+requests = LazyModule("requests")
+requests_adapters = LazyModule("requests.adapters")
+urllib3_retry = LazyModule("urllib3.util.retry")
+gql = LazyModule("gql")
+graphql_printer = LazyModule("graphql.language.printer")
+konoha = LazyModule("konoha")
+html_chunks = LazyModule("html_chunks")
+np = LazyModule("numpy")
+tfidf_format = LazyModule("tfidf_format")
+related_notes = LazyModule("related_notes")
+wordcloud_renderer = LazyModule("wordcloud_renderer")
 
 wc_config = dict(
     font_path="/fonts/GenJyuuGothic-Normal.ttf",
@@ -35,42 +115,149 @@ wc_config = dict(
     colormap="Dark2",
 )
 
-ssm_client = boto3.client("ssm")
+
 kibela_team_name = os.environ["SSM_KIBELA_TEAM"]
 kibela_token_name = os.environ["SSM_KIBELA_TOKEN"]
-ssm_response = ssm_client.get_parameters(Names=[kibela_team_name, kibela_token_name])
-for param in ssm_response["Parameters"]:
-    if param["Name"] == kibela_team_name:
-        kibela_team = param["Value"]
-    elif param["Name"] == kibela_token_name:
-        kibela_token = param["Value"]
-if not kibela_team or not kibela_token:
-    raise Exception("can't retrieve ssm")
-
-s3_client = boto3.client("s3")
-s3_resource = boto3.resource("s3")
+kibela_secrets = ssm_cache.SecretsCache(
+    [kibela_team_name, kibela_token_name],
+    ttl=int(os.environ.get("SSM_CACHE_TTL", "300")),
+    cache_path=os.environ.get("SSM_CACHE_PATH"),
+)
+
+
+def get_kibela_secrets():
+    return kibela_secrets.get(kibela_team_name), kibela_secrets.get(kibela_token_name)
+
+
+def get_kibela_team():
+    return kibela_secrets.get(kibela_team_name)
+
+
 public_bucket_name = os.environ["S3_PUBLIC"]
 private_bucket_name = os.environ["S3_PRIVATE"]
 
-public_bucket = s3_resource.Bucket(public_bucket_name)
-private_bucket = s3_resource.Bucket(private_bucket_name)
-
-# Select your transport with a defined url endpoint
-transport = RequestsHTTPTransport(
-    url=f"https://{kibela_team}.kibe.la/api/v1",
-    headers={
-        "Authorization": f"Bearer {kibela_token}",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        # "User-Agent": user_agent
-    },
+
+def create_s3_resource():
+    resource = boto3.resource("s3")
+    action_metrics.instrument_boto3_client(resource.meta.client)
+    return resource
+
+
+s3_client = LazyObject(
+    "s3_client", lambda: action_metrics.instrument_boto3_client(boto3.client("s3"))
+)
+s3_resource = LazyObject("s3_resource", create_s3_resource)
+public_bucket = LazyObject(
+    "public_bucket", lambda: s3_resource.Bucket(public_bucket_name)
+)
+private_bucket = LazyObject(
+    "private_bucket", lambda: s3_resource.Bucket(private_bucket_name)
 )
 
-# Create a GraphQL client using the defined transport
-gql_client = Client(transport=transport, fetch_schema_from_transport=False)
+# クエリ名 -> [回数, 合計秒数]
+kibela_latency = defaultdict(lambda: [0, 0.0])
 
-note_id_from_path = gql(
+
+class KibelaClient:
+    """コネクションを使いまわすKibela GraphQLクライアント
+
+    gql 2のRequestsHTTPTransportはリクエストごとにTLS接続を張り直すので、
+    プロセス全体で1つのrequests.Sessionを共有する。
+    クエリは冪等なので429/5xxはRetry-Afterに従ってリトライする。
     """
+
+    def __init__(self, get_credentials, pool_size=10, timeout=30, retries=3):
+        # get_credentials: () -> (team, token)
+        # トークンのローテーションに追従するためリクエストごとに取り出す
+        self.get_credentials = get_credentials
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(
+            {
+                "Content-Type": "application/json",
+                "Accept": "application/json",
+                # "User-Agent": user_agent
+            }
+        )
+        retry = urllib3_retry.Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(["POST"]),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = requests_adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session.mount("https://", adapter)
+        self.queries = {}
+
+    def _print_query(self, source):
+        # クエリはgqlで一度だけパースして検証・整形する
+        if source not in self.queries:
+            document = gql.gql(source)
+            field = document.definitions[0].selection_set.selections[0]
+            name = (field.alias or field.name).value
+            self.queries[source] = (graphql_printer.print_ast(document), name)
+        return self.queries[source]
+
+    def _post(self, query, variable_values):
+        team, token = self.get_credentials()
+        return self.session.post(
+            f"https://{team}.kibe.la/api/v1",
+            json={"query": query, "variables": variable_values or {}},
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=self.timeout,
+        )
+
+    def execute(self, document, variable_values=None, allow_partial=False):
+        # allow_partial: エイリアスで複数の記事を取るクエリ用。
+        # 削除された記事などのエラーはその記事だけnullにして残りの結果を返す
+        query, name = self._print_query(document)
+        start = time.perf_counter()
+        response = self._post(query, variable_values)
+        if response.status_code == 401:
+            # トークンが更新されたかもしれないのでSSMから取り直して1回だけやり直す
+            logger.info("kibela returned 401. refresh secrets.")
+            kibela_secrets.invalidate()
+            response = self._post(query, variable_values)
+        elapsed = time.perf_counter() - start
+        kibela_latency[name][0] += 1
+        kibela_latency[name][1] += elapsed
+        action_metrics.add("KibelaCalls")
+        action_metrics.add("KibelaReceivedBytes", len(response.content))
+        action_metrics.add_time("Kibela", elapsed)
+        response.raise_for_status()
+        result = response.json()
+        if result.get("errors"):
+            if not allow_partial or result.get("data") is None:
+                raise Exception(f"GraphQL error: {result['errors']}")
+            logger.warning(f"GraphQL partial error: {result['errors']}")
+        return result["data"]
+
+
+def log_kibela_latency():
+    for name, (count, total) in kibela_latency.items():
+        logger.info(
+            f"kibela query {name}: count={count} total={total:.3f}s "
+            f"avg={total / count:.3f}s"
+        )
+    kibela_latency.clear()
+
+
+def create_kibela_client():
+    return KibelaClient(
+        get_kibela_secrets,
+        pool_size=int(os.environ.get("KIBELA_POOL_SIZE", "10")),
+        timeout=float(os.environ.get("KIBELA_TIMEOUT", "30")),
+        retries=int(os.environ.get("KIBELA_RETRIES", "3")),
+    )
+
+
+gql_client = LazyObject("kibela_client", create_kibela_client)
+
+note_id_from_path = """
 query($path: String!) {
   note: noteFromPath(path: $path) {
     id
@@ -79,11 +266,9 @@ query($path: String!) {
   }
 }
 """
-)
 
 
-note_from_id = gql(
-    """
+note_from_id = """
 query($id: ID!) {
     note(id: $id) {
         id
@@ -92,12 +277,23 @@ query($id: ID!) {
     }
 }
 """
-)
 
-notes_first = gql(
-    """
-query {
-  notes(first:10, orderBy:{field:CONTENT_UPDATED_AT, direction:ASC}){
+notes_per_query = int(os.environ.get("NOTES_PER_QUERY", "20"))
+
+
+@functools.lru_cache(maxsize=None)
+def notes_from_ids(count, fields="id title contentHtml"):
+    # note(id:)をエイリアスで並べて複数記事を1リクエストで取得する
+    params = ", ".join(f"$id{i}: ID!" for i in range(count))
+    notes = "\n".join(f"  n{i}: note(id: $id{i}) {{ {fields} }}" for i in range(count))
+    return f"query({params}) {{\n{notes}\n}}"
+
+
+notes_page_size = int(os.environ.get("NOTES_PAGE_SIZE", "100"))
+
+notes_page = """
+query($first: Int!, $cursor: String) {
+  notes(first:$first, after: $cursor, orderBy:{field:CONTENT_UPDATED_AT, direction:ASC}){
     nodes{
       id
       contentUpdatedAt
@@ -107,30 +303,11 @@ query {
       hasNextPage
       endCursor
     }
-    totalCount
-  }
-}
-"""
-)
-
-notes_secdond = gql(
-    """
-query($count: Int, $cursor: String) {
-  notes(first:$count, after: $cursor, orderBy:{field:CONTENT_UPDATED_AT, direction:ASC}){
-    nodes{
-      id
-      contentUpdatedAt
-      isArchived
-    }
   }
 }
 """
-)
 
-note_detail_from_id = gql(
-    """
-query($id: ID!) {
-  note(id: $id) {
+note_detail_fields = """
     author {
       realName
       url
@@ -159,209 +336,1384 @@ query($id: ID!) {
     url
     publishedAt
     contentUpdatedAt
-  }
-}
 """
-)
+
+note_detail_from_id = f"""
+query($id: ID!) {{
+  note(id: $id) {{
+{note_detail_fields}
+  }}
+}}
+"""
+
+# unfurl用: 記事の特定と展開に必要な情報を1回のリクエストで取る
+note_detail_from_path = f"""
+query($path: String!) {{
+  note: noteFromPath(path: $path) {{
+{note_detail_fields}
+    isArchived
+  }}
+}}
+"""
 
 
 def get_tfidf_png_key(id_):
     return f"wc_tf_idf/{id_}.png"
 
 
+def get_tfidf_terms_key(id_):
+    return f"tfidf_terms/{id_}.json"
+
+
 def get_tf_tsv_key(id_):
     return f"tf/{id_}.tsv"
 
 
-def update_tf(id_):
-    result = gql_client.execute(note_from_id, variable_values={"id": id_})
-    note = result["note"]
-    html = note["contentHtml"]
-    text = html_text.extract_text(html)
-    tokenizer = WordTokenizer("sudachi", mode="C", with_postag=True)
-    words = tokenizer.tokenize(text)
-    hiragana_re = re.compile("[\u3041-\u309F]+")
-    number_re = re.compile("[0-9,.]+")
-    filtered_words = list(
-        filter(
-            # lambda x: len(x) > 3 or not hiragana_re.fullmatch(x),
-            lambda x: (len(x) > 3 if hiragana_re.fullmatch(x) else len(x) > 1)
-            and not number_re.fullmatch(x),
-            # map(lambda x: x.normalized_form, filter(lambda x: x.postag in ["名詞", "動詞"], words)),
-            map(lambda x: x.surface, filter(lambda x: x.postag in ["名詞"], words)),
+def get_tf_bin_key(id_):
+    return f"tf/{id_}.bin"
+
+
+def get_tf_cache_key(id_):
+    # tf/の下に置くとIDFの再計算でTFとして読まれるので分ける
+    return f"tf_cache/{id_}.json"
+
+
+idf_tsv_key = "idf.tsv"
+idf_bin_key = "idf.bin"
+
+# 0より大きければ記事ごとのTFをシャードにまとめる
+# tf/{id}.binは次のコンパクションまでシャードの内容より優先され、
+# 空のtf/{id}.binは削除済みを表す
+tf_shard_count = int(os.environ.get("TF_SHARDS", "0"))
+tf_shard_prefix = "tf_shards/"
+
+
+def get_tf_shard_no(id_):
+    return tfidf_format.term_id(id_) % tf_shard_count
+
+
+def get_tf_shard_index_key(shard_no):
+    return f"{tf_shard_prefix}{shard_no}.json"
+
+
+df_state_key = "df.json"
+manifest_key = "manifest.json"
+
+
+def get_object_body(key):
+    try:
+        ret = private_bucket.Object(key).get()
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        raise
+    return ret["Body"].read()
+
+
+# キー -> (ETag, loaderで読み込んだ値)
+_object_cache = {}
+
+
+def get_object_if_changed(key, loader):
+    # ETagが変わっていなければwarmなコンテナで読み込み済みの値を使う。無ければNone
+    kwargs = {"Bucket": private_bucket_name, "Key": key}
+    cached = _object_cache.get(key)
+    if cached is not None:
+        kwargs["IfNoneMatch"] = cached[0]
+    try:
+        ret = s3_client.get_object(**kwargs)
+    except botocore.exceptions.ClientError as e:
+        code = e.response["Error"]["Code"]
+        if code in ["304", "NotModified"]:
+            return cached[1]
+        if code == "NoSuchKey":
+            _object_cache.pop(key, None)
+            return None
+        raise
+    value = loader(ret["Body"].read())
+    _object_cache[key] = (ret["ETag"], value)
+    return value
+
+
+def delete_private_keys(keys):
+    keys = list(keys)
+    for i in range(0, len(keys), 1000):
+        private_bucket.delete_objects(
+            Delete={"Objects": [{"Key": key} for key in keys[i : i + 1000]]}
         )
+
+
+def parse_tf_tsv(body):
+    lines = body.decode("utf-8").split("\n")
+    return dict(map(lambda x: to_f_map(x.split("\t")), filter(None, lines)))
+
+
+def get_tf_shard_index(key):
+    index = get_object_if_changed(key, json.loads)
+    if index is None:
+        return {"data": None, "notes": {}}
+    return index
+
+
+def get_tf_bin_from_shard(id_):
+    if tf_shard_count == 0:
+        return None
+    index = get_tf_shard_index(get_tf_shard_index_key(get_tf_shard_no(id_)))
+    if id_ not in index["notes"]:
+        return None
+    offset, length, _ = index["notes"][id_]
+    ret = s3_client.get_object(
+        Bucket=private_bucket_name,
+        Key=index["data"],
+        Range=f"bytes={offset}-{offset + length - 1}",
     )
-    num_words = len(filtered_words)
-    word_count = Counter(filtered_words)
+    return ret["Body"].read()
+
+
+def get_tf_from_s3(id_):
+    # 移行期間中はバイナリが無ければ従来のTSVを読む
+    body = get_object_body(get_tf_bin_key(id_))
+    if body is None:
+        body = get_tf_bin_from_shard(id_)
+    if body == b"":
+        return None
+    if body is not None:
+        words, _, counts, num_words = tfidf_format.decode_tf(body)
+        return dict(zip(words, (counts / num_words).tolist()))
+    body = get_object_body(get_tf_tsv_key(id_))
+    if body is not None:
+        return parse_tf_tsv(body)
+    return None
+
+
+def get_tf_words_from_s3(id_):
+    tf = get_tf_from_s3(id_)
+    if tf is None:
+        return None
+    return set(tf)
+
+
+def get_tf_updated_at(id_):
+    try:
+        return private_bucket.Object(get_tf_bin_key(id_)).last_modified.isoformat()
+    except botocore.exceptions.ClientError:
+        pass
+    if tf_shard_count > 0:
+        index = get_tf_shard_index(get_tf_shard_index_key(get_tf_shard_no(id_)))
+        if id_ in index["notes"]:
+            return index["notes"][id_][2]
+    try:
+        return private_bucket.Object(get_tf_tsv_key(id_)).last_modified.isoformat()
+    except botocore.exceptions.ClientError:
+        pass
+    return None
+
+
+def get_df_state_from_s3():
+    try:
+        ret = private_bucket.Object(df_state_key).get()
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        raise
+    state = json.loads(ret["Body"].read())
+    return state["num_docs"], Counter(state["df"])
+
+
+def put_df_state_to_s3(num_docs, df):
+    state = {"num_docs": num_docs, "df": df}
+    private_bucket.put_object(
+        Body=json.dumps(state, ensure_ascii=False).encode("utf-8"), Key=df_state_key
+    )
+
+
+def put_idf_to_s3(num_docs, df):
+    private_bucket.put_object(
+        Body=tfidf_format.encode_idf(num_docs, df), Key=idf_bin_key
+    )
+
+
+def update_df_state(old_words, new_words):
+    # 記事1件分の単語集合の差分だけ文書頻度を更新する
+    return update_df_state_many([(old_words, new_words)])
+
+
+def update_df_state_many(changes):
+    # 複数記事の差分を1回の読み書きでまとめて反映する
+    # changes: [(old_words, new_words)]
+    state = get_df_state_from_s3()
+    if state is None:
+        logger.info("df state not found. skip incremental update.")
+        return False
+    num_docs, df = state
+    removed = added = 0
+    for old_words, new_words in changes:
+        if old_words is None:
+            num_docs += 1
+            old_words = set()
+        for word in old_words - new_words:
+            df[word] -= 1
+            if df[word] <= 0:
+                del df[word]
+        for word in new_words - old_words:
+            df[word] += 1
+        removed += len(old_words - new_words)
+        added += len(new_words - old_words)
+    put_df_state_to_s3(num_docs, df)
+    logger.info(
+        f"df state updated: notes={len(changes)} num_docs={num_docs} "
+        f"-{removed} +{added}"
+    )
+    return True
+
+
+hiragana_re = re.compile("[\u3041-\u309F]+")
+number_re = re.compile("[0-9,.]+")
+
+# warmなコンテナではSudachiの辞書読み込みを使いまわす
+# (辞書ファイルはsudachipy側でmmapされる)
+_tokenizer = None
+
+
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        start = time.perf_counter()
+        _tokenizer = konoha.WordTokenizer("sudachi", mode="C", with_postag=True)
+        logger.info(f"tokenizer setup: {time.perf_counter() - start:.3f}s")
+    return _tokenizer
+
+
+def is_target_word(word):
+    # return len(word) > 3 or not hiragana_re.fullmatch(word)
+    return (
+        len(word) > 3 if hiragana_re.fullmatch(word) else len(word) > 1
+    ) and not number_re.fullmatch(word)
+
+
+# 本文から除くタグ
+html_kill_tags = ["code", "blockquote"]
+# 1回に形態素解析する文字数。Sudachiの入力上限(約49KB)より十分小さくする
+tokenize_chunk_chars = int(os.environ.get("TOKENIZE_CHUNK_CHARS", "4000"))
+
+
+def count_chunk_words(tokenizer, chunk, word_count):
+    for token in tokenizer.tokenize(chunk):
+        # if token.postag in ["名詞", "動詞"]: token.normalized_form
+        if token.postag == "名詞" and is_target_word(token.surface):
+            word_count[token.surface] += 1
+    return word_count
+
+
+def count_words_in_chunks(chunks):
+    # チャンクごとに形態素解析して名詞を数える。(Counter, 文字数)を返す
+    tokenizer = get_tokenizer()
+    word_count = Counter()
+    chars = 0
+    for chunk in chunks:
+        chars += len(chunk)
+        count_chunk_words(tokenizer, chunk, word_count)
+    return word_count, chars
+
+
+# 段落のハッシュ -> 名詞の数 を記事ごとに保存し、変わった段落だけ形態素解析する
+# 形態素解析や数える単語の条件を変えたらtf_cache_versionを上げる
+tf_cache_enabled = os.environ.get("TF_CACHE", "1") == "1"
+tf_cache_version = 1
+
+
+def get_tf_cache_from_s3(id_):
+    body = get_object_body(get_tf_cache_key(id_))
+    if body is None:
+        return {}
+    cache = json.loads(body)
+    if cache.get("version") != tf_cache_version:
+        return {}
+    return cache["paragraphs"]
+
+
+def put_tf_cache_to_s3(id_, paragraphs):
+    body = {"version": tf_cache_version, "paragraphs": paragraphs}
+    private_bucket.put_object(
+        Body=json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode(
+            "utf-8"
+        ),
+        Key=get_tf_cache_key(id_),
+    )
+
+
+def paragraph_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def count_paragraph_words(html, cache):
+    # (Counter, 文字数, 新しいキャッシュ)を返す
+    # 新しいキャッシュには今の段落だけを残す
+    tokenizer = get_tokenizer()
+    skip_tags = html_chunks.SKIP_TAGS | set(html_kill_tags)
+    word_count = Counter()
+    new_cache = {}
+    chars = 0
+    misses = 0
+    for block in html_chunks.iter_blocks(html or "", skip_tags):
+        for text in html_chunks.split_text(block, tokenize_chunk_chars):
+            chars += len(text)
+            key = paragraph_hash(text)
+            counts = new_cache.get(key)
+            if counts is None:
+                counts = cache.get(key)
+            if counts is None:
+                counts = count_chunk_words(tokenizer, text, Counter())
+                misses += 1
+            new_cache[key] = counts
+            word_count.update(counts)
+    action_metrics.add("ParagraphMisses", misses)
+    action_metrics.add("ParagraphHits", len(new_cache) - misses)
+    return word_count, chars, new_cache
+
+
+def count_html_words(html, cache=None):
+    # cacheを渡したときは段落ごとに、渡さなければチャンクにまとめて解析する
+    if cache is not None:
+        return count_paragraph_words(html, cache)
+    skip_tags = html_chunks.SKIP_TAGS | set(html_kill_tags)
+    word_count, chars = count_words_in_chunks(
+        html_chunks.iter_chunks(html or "", tokenize_chunk_chars, skip_tags)
+    )
+    return word_count, chars, None
+
+
+def put_tf_outputs_to_s3(id_, word_count, incremental, cache, new_cache):
+    word_freq = put_tf_to_s3(id_, word_count, incremental)
+    if new_cache is not None and new_cache.keys() != cache.keys():
+        put_tf_cache_to_s3(id_, new_cache)
+    return word_freq
+
+
+def put_tf_to_s3(id_, word_count, incremental=False):
+    num_words = sum(word_count.values())
     word_freq_list = list(map(lambda k: (k, word_count[k] / num_words), word_count))
     word_freq = dict(word_freq_list)
-    tf_tsv_key = get_tf_tsv_key(id_)
-    tf_tsv = "\n".join(map(lambda x: "\t".join(map(str, x)), word_freq_list))
-    private_bucket.put_object(Body=tf_tsv.encode("utf-8"), Key=tf_tsv_key)
+    if incremental:
+        old_words = get_tf_words_from_s3(id_)
+    private_bucket.put_object(
+        Body=tfidf_format.encode_tf(word_count), Key=get_tf_bin_key(id_)
+    )
+    if incremental:
+        update_df_state(old_words, set(word_freq))
+    return word_freq
+
+
+def update_tf(id_, incremental=False):
+    cold = _tokenizer is None
+    start = time.perf_counter()
+    get_tokenizer()
+    setup_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = gql_client.execute(note_from_id, variable_values={"id": id_})
+    note = result["note"]
+    html = note["contentHtml"]
+    cache = get_tf_cache_from_s3(id_) if tf_cache_enabled else None
+    fetch_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    word_count, chars, new_cache = count_html_words(html, cache)
+    tokenize_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    word_freq = put_tf_outputs_to_s3(id_, word_count, incremental, cache, new_cache)
+    put_time = time.perf_counter() - start
+    logger.info(
+        f"update_tf [{id_}] cold={cold} setup={setup_time:.3f}s "
+        f"fetch={fetch_time:.3f}s tokenize={tokenize_time:.3f}s "
+        f"put={put_time:.3f}s chars={chars} words={len(word_freq)}"
+    )
+    action_metrics.add_times(
+        Setup=setup_time, Fetch=fetch_time, Tokenize=tokenize_time, Put=put_time
+    )
+    action_metrics.add("Notes")
+    action_metrics.add("Chars", chars)
+    action_metrics.add("Words", sum(word_count.values()))
     return word_freq
 
 
+def get_notes_from_ids(id_list, fields="id title contentHtml"):
+    notes = []
+    for i in range(0, len(id_list), notes_per_query):
+        ids = id_list[i : i + notes_per_query]
+        result = gql_client.execute(
+            notes_from_ids(len(ids), fields),
+            variable_values=dict((f"id{j}", id_) for j, id_ in enumerate(ids)),
+            allow_partial=True,
+        )
+        notes += [result.get(f"n{j}") for j in range(len(ids))]
+    return notes
+
+
+def update_tf_batch(id_list, incremental=False):
+    """TFを書いた記事のidを返す。Kibelaから取れなかった記事は含めない"""
+    cold = _tokenizer is None
+    start = time.perf_counter()
+    get_tokenizer()
+    setup_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    notes = list(filter(None, get_notes_from_ids(id_list)))
+    ids = list(map(lambda x: x["id"], notes))
+    caches = dict.fromkeys(ids)
+    old_words = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        if tf_cache_enabled:
+            caches = dict(zip(ids, executor.map(get_tf_cache_from_s3, ids)))
+        if incremental:
+            old_words = dict(zip(ids, executor.map(get_tf_words_from_s3, ids)))
+    fetch_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    word_counts = []
+    for note in notes:
+        cache = caches[note["id"]]
+        word_count, chars, new_cache = count_html_words(note["contentHtml"], cache)
+        word_counts.append((note["id"], word_count, cache, new_cache))
+        action_metrics.add("Chars", chars)
+    tokenize_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        # df.jsonはスレッドごとに書き換えると更新が消えるので最後にまとめて反映する
+        futures = [
+            executor.submit(
+                put_tf_outputs_to_s3, id_, word_count, False, cache, new_cache
+            )
+            for id_, word_count, cache, new_cache in word_counts
+        ]
+        for future in futures:
+            future.result()
+    if incremental:
+        # 本文が空になった記事も古い単語を減らすために含める
+        update_df_state_many(
+            [(old_words[id_], set(word_count)) for id_, word_count, _, _ in word_counts]
+        )
+    put_time = time.perf_counter() - start
+    logger.info(
+        f"update_tf_batch cold={cold} notes={len(id_list)} setup={setup_time:.3f}s "
+        f"fetch={fetch_time:.3f}s tokenize={tokenize_time:.3f}s put={put_time:.3f}s"
+    )
+    action_metrics.add_times(
+        Setup=setup_time, Fetch=fetch_time, Tokenize=tokenize_time, Put=put_time
+    )
+    action_metrics.add("Notes", len(word_counts))
+    action_metrics.add("Words", sum(map(lambda x: sum(x[1].values()), word_counts)))
+    return ids
+
+
 def get_tfidf_png_url(id_):
     pngkey = get_tfidf_png_key(id_)
     return f"""https://{public_bucket_name}.s3.amazonaws.com/{pngkey}"""
 
 
+def iter_notes(page_size=None):
+    cursor = None
+    while True:
+        result = gql_client.execute(
+            notes_page,
+            variable_values={"first": page_size or notes_page_size, "cursor": cursor},
+        )
+        yield from result["notes"]["nodes"]
+        if not result["notes"]["pageInfo"]["hasNextPage"]:
+            break
+        cursor = result["notes"]["pageInfo"]["endCursor"]
+
+
 def get_page_ids():
-    result = gql_client.execute(notes_first, variable_values={})
-    ids_first = result["notes"]["nodes"]
-    if result["notes"]["pageInfo"]["hasNextPage"]:
-        remain_count = result["notes"]["totalCount"] - len(ids_first)
-        second_result = gql_client.execute(
-            notes_secdond,
-            variable_values={
-                "count": remain_count,
-                "cursor": result["notes"]["pageInfo"]["endCursor"],
-            },
+    return list(iter_notes())
+
+
+def put_note_chunks(notes, chunk_size):
+    # Step Functionsのペイロード上限を避けるため記事一覧はS3に置いてキーだけ返す
+    prefix = f"enumerate/{int(time.time() * 1000)}/"
+    chunk_keys = []
+
+    def put_chunk(chunk):
+        key = f"{prefix}{len(chunk_keys):05}.json"
+        put_note_chunk(key, chunk)
+        chunk_keys.append(key)
+
+    chunk = []
+    for note in notes:
+        chunk.append(note)
+        if len(chunk) >= chunk_size:
+            put_chunk(chunk)
+            chunk = []
+    if chunk:
+        put_chunk(chunk)
+    return chunk_keys
+
+
+def put_url_chunks(urls, chunk_size):
+    # webhookでまとめて届いた記事URLをenumerate_stale_notesと同じ形のチャンクにする
+    notes = {}
+    for url in urls:
+        try:
+            note = get_note_id_from_url(url)
+        except Exception as e:
+            # 削除された記事などは飛ばして他の記事を更新する
+            logger.error(f"get_note_id_from_url [{url}] Exception: {e}")
+            continue
+        need_tf = is_stale(note["contentUpdatedAt"], note["tfTsvUpdatedAt"])
+        need_png = need_tf or is_stale(
+            note["contentUpdatedAt"], note["tfidfPngUpdatedAt"]
         )
-        ids_second = second_result["notes"]["nodes"]
-        return ids_first + ids_second
-    else:
-        return ids_first
+        notes[note["id"]] = dict(note, needTf=need_tf, needPng=need_png)
+    logger.info(f"urls:{len(urls)} notes:{len(notes)}")
+    chunk_keys = put_note_chunks(notes.values(), chunk_size)
+    idf_outdated = any(map(lambda x: x["needTf"], notes.values()))
+    return chunk_keys, idf_outdated
+
+
+def put_note_chunk(key, notes):
+    private_bucket.put_object(
+        Body=json.dumps(notes, separators=(",", ":")).encode("utf-8"), Key=key
+    )
+
+
+def get_note_chunk(key):
+    return json.loads(private_bucket.Object(key).get()["Body"].read())
 
 
 def delete_tf_s3(id_):
-    tf_tsv_key = get_tf_tsv_key(id_)
-    try:
-        obj = private_bucket.Object(tf_tsv_key)
-        obj.delete()
-    except Exception as e:
-        logger.error(f"Delete [{id_}] Exception: {e}")
+    if tf_shard_count > 0:
+        # シャードから消すのはコンパクション時
+        private_bucket.put_object(Body=b"", Key=get_tf_bin_key(id_))
+        keys = [get_tf_tsv_key(id_), get_tf_cache_key(id_)]
+    else:
+        keys = [get_tf_bin_key(id_), get_tf_tsv_key(id_), get_tf_cache_key(id_)]
+    for key in keys:
+        try:
+            obj = private_bucket.Object(key)
+            obj.delete()
+        except Exception as e:
+            logger.error(f"Delete [{id_}] Exception: {e}")
+
+
+def delete_tfidf_png_s3(id_):
+    for bucket, key in [
+        (public_bucket, get_tfidf_png_key(id_)),
+        (private_bucket, get_tfidf_terms_key(id_)),
+    ]:
+        try:
+            obj = bucket.Object(key)
+            obj.delete()
+        except Exception as e:
+            logger.error(f"Delete [{id_}] Exception: {e}")
+
+
+def now_isoformat():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def is_stale(content_updated_at, updated_at):
+    if updated_at is None:
+        return True
+    return datetime.datetime.fromisoformat(
+        content_updated_at
+    ) > datetime.datetime.fromisoformat(updated_at)
+
+
+def get_manifest_from_s3():
+    # {id: [contentUpdatedAt, tfTsvUpdatedAt, tfidfPngUpdatedAt]}
+    # キャッシュした値を書き換えないようにコピーを返す
+    return dict(get_object_if_changed(manifest_key, json.loads) or {})
+
+
+def put_manifest_to_s3(manifest):
+    private_bucket.put_object(
+        Body=json.dumps(manifest, separators=(",", ":")).encode("utf-8"),
+        Key=manifest_key,
+    )
+
+
+def enumerate_stale_notes(chunk_size):
+    manifest = get_manifest_from_s3()
+    alive_ids = set()
+    stats = Counter()
 
+    def iter_stale_notes():
+        for note in iter_notes():
+            stats["notes"] += 1
+            if note["isArchived"]:
+                continue
+            alive_ids.add(note["id"])
+            _, tf_updated_at, png_updated_at = manifest.get(note["id"], [None] * 3)
+            need_tf = is_stale(note["contentUpdatedAt"], tf_updated_at)
+            need_png = need_tf or is_stale(note["contentUpdatedAt"], png_updated_at)
+            if need_png:
+                stats["stale"] += 1
+                stats["needTf"] += need_tf
+                yield dict(
+                    note,
+                    needTf=need_tf,
+                    needPng=need_png,
+                    tfTsvUpdatedAt=tf_updated_at,
+                    tfidfPngUpdatedAt=png_updated_at,
+                )
 
-def update_idf():
+    chunk_keys = put_note_chunks(iter_stale_notes(), chunk_size)
+
+    removed_ids = [id_ for id_ in manifest if id_ not in alive_ids]
+    for id_ in removed_ids:
+        logger.info(f"remove outputs [{id_}]")
+        delete_tf_s3(id_)
+        delete_tfidf_png_s3(id_)
+        del manifest[id_]
+    if removed_ids:
+        put_manifest_to_s3(manifest)
+
+    idf_outdated = len(removed_ids) > 0 or stats["needTf"] > 0
+    logger.info(
+        f"notes:{stats['notes']} stale:{stats['stale']} removed:{len(removed_ids)}"
+    )
+    return chunk_keys, idf_outdated
+
+
+def update_manifest(chunk_keys):
+    manifest = get_manifest_from_s3()
+    for key in chunk_keys:
+        for note in get_note_chunk(key):
+            manifest[note["id"]] = [
+                note["contentUpdatedAt"],
+                note.get("tfTsvUpdatedAt"),
+                note.get("tfidfPngUpdatedAt"),
+            ]
+    put_manifest_to_s3(manifest)
+    delete_private_keys(chunk_keys)
+
+
+def update_idf(rebuild=False):
+    if not rebuild:
+        state = get_df_state_from_s3()
+        if state is not None:
+            num_docs, df = state
+            logger.info(f"update idf from df state. num_docs:{num_docs}")
+            put_idf_to_s3(num_docs, df)
+            return
+        logger.info("df state not found. fallback to rebuild.")
+    rebuild_idf()
+
+
+def list_private_objects(prefix):
     ret = s3_client.list_objects_v2(
-        Bucket=private_bucket_name, Prefix="tf/", MaxKeys=10
+        Bucket=private_bucket_name, Prefix=prefix, MaxKeys=1000
     )
-    key_list = list(map(lambda x: x["Key"], ret["Contents"]))
+    contents = ret.get("Contents", [])
     while ret["IsTruncated"]:
         ret = s3_client.list_objects_v2(
             Bucket=private_bucket_name,
-            Prefix="tf/",
+            Prefix=prefix,
             MaxKeys=1000,
             ContinuationToken=ret["NextContinuationToken"],
         )
-        key_list += map(lambda x: x["Key"], ret["Contents"])
-
-    def get_counter_from_s3key(key):
-        obj = private_bucket.Object(key)
-        ret = obj.get()
-        words = map(
-            lambda line: line.decode("utf-8").split("\t")[0],
-            ret["Body"].iter_lines(),
-        )
-        return Counter(words)
+        contents += ret["Contents"]
+    return contents
 
-    def get_counter_from_s3key_list(keylist):
-        counter = Counter()
-        for key in keylist:
-            obj = private_bucket.Object(key)
-            ret = obj.get()
-            words = map(
-                lambda line: line.decode("utf-8").split("\t")[0],
-                ret["Body"].iter_lines(),
+
+def get_note_id_from_tf_key(key):
+    return os.path.splitext(key[len("tf/") :])[0]
+
+
+def list_tf_shard_indexes():
+    index_keys = filter(
+        lambda x: x.endswith(".json"),
+        map(lambda x: x["Key"], list_private_objects(tf_shard_prefix)),
+    )
+    return dict(map(lambda key: (key, get_tf_shard_index(key)), index_keys))
+
+
+idf_workers = int(os.environ.get("IDF_WORKERS", "20"))
+
+
+def iter_bounded(executor, fn, items, max_pending):
+    # 実行中・未回収のfutureをmax_pending件までにしながら(item, future)を返す
+    pending = {}
+    for item in items:
+        pending[executor.submit(fn, item)] = item
+        if len(pending) >= max_pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
             )
-            counter.update(words)
-        return counter
+            for future in done:
+                yield pending.pop(future), future
+    for future in concurrent.futures.as_completed(list(pending)):
+        yield pending.pop(future), future
+
+
+def plan_idf_rebuild():
+    key_list = list(map(lambda x: x["Key"], list_private_objects("tf/")))
+    shard_indexes = list_tf_shard_indexes()
+    pending_ids = set(
+        map(get_note_id_from_tf_key, filter(lambda x: x.endswith(".bin"), key_list))
+    )
+    sharded_ids = set(id_ for index in shard_indexes.values() for id_ in index["notes"])
+    # 記事ごとに tf/{id}.bin > シャード > tf/{id}.tsv の順で使う
+    overridden_ids = pending_ids | sharded_ids
+    key_list = list(
+        filter(
+            lambda x: x.endswith(".bin")
+            or get_note_id_from_tf_key(x) not in overridden_ids,
+            key_list,
+        )
+    )
+    key_list += list(shard_indexes)
+    return key_list, pending_ids, shard_indexes
 
 
-    num_files = len(key_list)
-    logger.info(f"num_files:{num_files}")
+def count_document_frequency(key_list, pending_ids, shard_indexes):
+    def get_words_from_s3key(key):
+        body = private_bucket.Object(key).get()["Body"].read()
+        if key.endswith(".bin"):
+            if body == b"":
+                return []
+            return [tfidf_format.decode_tf(body)[0]]
+        return [parse_tf_tsv(body).keys()]
 
+    def get_words_from_shard(index):
+        data = get_object_body(index["data"])
+        if data is None:
+            raise Exception(f"{index['data']} not found")
+        return [
+            tfidf_format.decode_tf(data[offset : offset + length])[0]
+            for id_, (offset, length, _) in index["notes"].items()
+            if id_ not in pending_ids
+        ]
+
+    def get_words_list(key):
+        # 記事ごとの単語リストのリストを返す
+        if key.startswith(tf_shard_prefix):
+            return get_words_from_shard(shard_indexes[key])
+        return get_words_from_s3key(key)
+
+    logger.info(f"num_files:{len(key_list)} shards:{len(shard_indexes)}")
+
+    # 取得は並列、集計は1つのCounterにその場で足し込む
+    # 取得済みで未集計の結果はidf_workersの2倍までに抑える
     counter = Counter()
-    # for key in key_list:
-    #     counter += get_counter_from_s3key(key)
-    # counter_list = Parallel(n_jobs=10)(
-    #     delayed(get_counter_from_s3key)(key) for key in key_list
-    # )
-    num_parallel = 20
-    key_list_list = [key_list[i::num_parallel] for i in range(num_parallel)]
-
-    # with multiprocessing.Pool(num_parallel) as pool:
-    #     counter_list = pool.map(get_counter_from_s3key_list, key_list_list)
-    # for c in counter_list:
-    #     counter += c
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_parallel) as executor:
-        future_to_counter = {executor.submit(get_counter_from_s3key_list, keys): keys for keys in key_list_list}
-        for future in concurrent.futures.as_completed(future_to_counter):
-            keys = future_to_counter[future]
+    num_files = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=idf_workers) as executor:
+        for key, future in iter_bounded(
+            executor, get_words_list, key_list, idf_workers * 2
+        ):
             try:
-                c = future.result()
+                words_list = future.result()
             except Exception as exc:
-                logger.error(f'{keys} generated an exception: {exc}')
-            else:
-                logger.info(f"counter: {c}")
-                counter += c
+                # 1キーがシャード1つ分の記事になるので、飛ばさずに失敗させて
+                # Step Functionsにやり直させる(欠けたdf.jsonを書かない)
+                logger.error(f"{key} generated an exception: {exc}")
+                raise
+            for words in words_list:
+                counter.update(words)
+                num_files += 1
+
+    logger.info(f"num_docs:{num_files} num_words:{len(counter)}")
+    return num_files, counter
+
 
-    idf_tsv = "\n".join(
-        map(lambda k: f"{k}\t{math.log(num_files / counter[k])}", counter)
+def rebuild_idf():
+    num_docs, df = count_document_frequency(*plan_idf_rebuild())
+    put_df_state_to_s3(num_docs, df)
+    put_idf_to_s3(num_docs, df)
+
+
+# IDFの再計算をLambdaで分散する場合
+# plan: 対象キーをnum_units個に分けてS3に置く
+# map: 担当分の文書頻度を部分結果として書き出す
+# reduce: 部分結果を足し合わせてdf.json/idf.binを書く
+def plan_idf_map_reduce(num_units):
+    key_list, pending_ids, _ = plan_idf_rebuild()
+    prefix = f"idf_parts/{int(time.time() * 1000)}/"
+    units = list(filter(None, [key_list[i::num_units] for i in range(num_units)]))
+    plan = {"pending_ids": list(pending_ids), "units": units}
+    private_bucket.put_object(
+        Body=json.dumps(plan).encode("utf-8"), Key=f"{prefix}plan.json"
+    )
+    return prefix, list(range(len(units)))
+
+
+def map_idf_unit(prefix, unit):
+    plan = json.loads(get_object_body(f"{prefix}plan.json"))
+    key_list = plan["units"][unit]
+    shard_indexes = dict(
+        (key, get_tf_shard_index(key))
+        for key in key_list
+        if key.startswith(tf_shard_prefix)
+    )
+    num_docs, df = count_document_frequency(
+        key_list, set(plan["pending_ids"]), shard_indexes
     )
-    private_bucket.put_object(Body=idf_tsv.encode("utf-8"), Key="idf.tsv")
+    part = {"num_docs": num_docs, "df": df}
+    private_bucket.put_object(
+        Body=json.dumps(part, ensure_ascii=False).encode("utf-8"),
+        Key=f"{prefix}part-{unit:05}.json",
+    )
+
+
+def reduce_idf(prefix):
+    keys = list(map(lambda x: x["Key"], list_private_objects(prefix)))
+    num_docs = 0
+    df = Counter()
+    for key in filter(lambda x: x.startswith(f"{prefix}part-"), keys):
+        part = json.loads(get_object_body(key))
+        num_docs += part["num_docs"]
+        df.update(part["df"])
+    logger.info(f"reduce idf: parts={len(keys) - 1} num_docs={num_docs}")
+    put_df_state_to_s3(num_docs, df)
+    put_idf_to_s3(num_docs, df)
+    delete_private_keys(keys)
+
+
+def delete_unchanged_objects(objects):
+    # objects: [(key, etag)] 読んだ後に書き換えられたものは消さない
+    keys = []
+    for key, etag in objects:
+        try:
+            ret = s3_client.head_object(Bucket=private_bucket_name, Key=key)
+        except botocore.exceptions.ClientError:
+            continue
+        if ret["ETag"] == etag:
+            keys.append(key)
+    delete_private_keys(keys)
+    return len(objects) - len(keys)
+
+
+def compact_tf_shard(shard_no, pending):
+    # pending: [(key, last_modified, etag)] このシャードに入る tf/{id}.bin
+    index_key = get_tf_shard_index_key(shard_no)
+    index = get_tf_shard_index(index_key)
+    data = get_object_body(index["data"]) if index["data"] else b""
+    records = dict(
+        (id_, (data[offset : offset + length], updated_at))
+        for id_, (offset, length, updated_at) in index["notes"].items()
+    )
+    compacted = []
+    for key, last_modified, etag in pending:
+        id_ = get_note_id_from_tf_key(key)
+        try:
+            ret = s3_client.get_object(Bucket=private_bucket_name, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                continue
+            raise
+        if ret["ETag"] != etag:
+            # 一覧を取った後にupdate_tfが書き換えたものは次のコンパクションに回す
+            continue
+        body = ret["Body"].read()
+        if body:
+            records[id_] = (body, last_modified.isoformat())
+        else:
+            records.pop(id_, None)
+        compacted.append((key, etag))
+
+    notes = {}
+    chunks = []
+    offset = 0
+    for id_, (body, updated_at) in records.items():
+        notes[id_] = [offset, len(body), updated_at]
+        chunks.append(body)
+        offset += len(body)
+    data_key = f"{tf_shard_prefix}{shard_no}/{int(time.time() * 1000)}.bin"
+    private_bucket.put_object(Body=b"".join(chunks), Key=data_key)
+    private_bucket.put_object(
+        Body=json.dumps({"data": data_key, "notes": notes}).encode("utf-8"),
+        Key=index_key,
+    )
+    if index["data"]:
+        delete_private_keys([index["data"]])
+    skipped = delete_unchanged_objects(compacted)
+    logger.info(
+        f"compact shard {shard_no}: notes={len(notes)} pending={len(pending)} "
+        f"compacted={len(compacted) - skipped} bytes={offset}"
+    )
+
+
+def compact_tf_shards():
+    if tf_shard_count == 0:
+        logger.info("TF_SHARDS is not set. skip compaction.")
+        return
+    pending_list = [[] for _ in range(tf_shard_count)]
+    for obj in list_private_objects("tf/"):
+        if obj["Key"].endswith(".bin"):
+            shard_no = get_tf_shard_no(get_note_id_from_tf_key(obj["Key"]))
+            pending_list[shard_no].append(
+                (obj["Key"], obj["LastModified"], obj["ETag"])
+            )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [
+            executor.submit(compact_tf_shard, shard_no, pending)
+            for shard_no, pending in enumerate(pending_list)
+            if pending
+        ]
+        for future in futures:
+            future.result()
 
 
 def to_f_map(tpl):
     return (tpl[0], float(tpl[1]))
 
 
+class IdfTable:
+    """単語IDでソートしたnumpy配列で持つIDF表"""
+
+    def __init__(self, ids, values):
+        self.ids = ids
+        self.values = values
+
+    @classmethod
+    def from_bin(cls, body):
+        ids, values, _ = tfidf_format.decode_idf(body)
+        return cls(ids, values)
+
+    @classmethod
+    def from_tsv(cls, body):
+        idf = parse_tf_tsv(body)
+        ids = tfidf_format.term_ids(list(idf))
+        order = np.argsort(ids)
+        values = np.fromiter(idf.values(), dtype="f8", count=len(idf))
+        return cls(ids[order], values[order])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_many(self, words, default=0.0):
+        result = np.full(len(words), default, dtype="f8")
+        if len(self.ids) == 0:
+            return result
+        ids = tfidf_format.term_ids(words)
+        index = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        found = self.ids[index] == ids
+        result[found] = self.values[index[found]]
+        return result
+
+    def get(self, word, default=None):
+        value = self.get_many([word], default=np.nan)[0]
+        return default if np.isnan(value) else float(value)
+
+
 def get_idf_from_s3():
-    idf_obj = private_bucket.Object("idf.tsv")
-    ret = idf_obj.get()
-    words = dict(
-        map(
-            lambda line: to_f_map(line.decode("utf-8").split("\t")),
-            ret["Body"].iter_lines(),
+    # 移行期間中はidf.binが無ければidf.tsvを読む
+    for key, loader in [
+        (idf_bin_key, IdfTable.from_bin),
+        (idf_tsv_key, IdfTable.from_tsv),
+    ]:
+        table = get_object_if_changed(key, loader)
+        if table is not None:
+            return table
+    raise Exception("idf not found")
+
+
+# フォントと描画設定はwarmなコンテナで使いまわす
+_renderer = None
+
+
+def get_renderer():
+    global _renderer
+    if _renderer is None:
+        _renderer = wordcloud_renderer.WordCloudRenderer(wc_config)
+    return _renderer
+
+
+def get_tf_idf(id_, idf_table, tf_words=None):
+    if tf_words is None:
+        tf_words = get_tf_from_s3(id_)
+        if tf_words is None:
+            return None
+    words = list(tf_words)
+    weights = np.fromiter(tf_words.values(), dtype="f8", count=len(words))
+    weights *= idf_table.get_many(words)
+    return dict(zip(words, weights.tolist()))
+
+
+# 単語の無い記事を描くときの仮の単語。描画にだけ使い、保存や関連記事には使わない
+placeholder_term = "?"
+
+
+def get_render_input(tf_idf):
+    return tf_idf or {placeholder_term: 1.0}
+
+
+tfidf_digest_words = 200  # WordCloudのmax_wordsの既定値
+tfidf_digest_metadata = "tfidf-digest"
+
+
+def get_tfidf_digest(tf_idf):
+    # 描画に使われる上位の単語と丸めた重み、描画設定が同じなら同じ画像とみなす
+    top = sorted(get_render_input(tf_idf).items(), key=lambda x: -x[1])[
+        :tfidf_digest_words
+    ]
+    max_weight = top[0][1] or 1.0
+    items = sorted(map(lambda x: (x[0], round(x[1] / max_weight, 3)), top))
+    payload = json.dumps(
+        [sorted(wc_config.items()), items], ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get_tfidf_png_digest(id_):
+    try:
+        ret = s3_client.head_object(
+            Bucket=public_bucket_name, Key=get_tfidf_png_key(id_)
         )
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+            return None
+        raise
+    return ret["Metadata"].get(tfidf_digest_metadata)
+
+
+def put_tfidf_png_to_s3(id_, png, digest):
+    with io.BytesIO(png) as bio:
+        pngkey = get_tfidf_png_key(id_)
+        public_bucket.upload_fileobj(
+            bio, pngkey, ExtraArgs={"Metadata": {tfidf_digest_metadata: digest}}
+        )
+
+
+def get_tfidf_png_updated_at(id_):
+    # 描画を飛ばした記事はPNGを書き換えず、確認した時刻をmanifestに残している
+    # (CopyObjectでLastModifiedを進めると記事ごとにPUTの料金がかかる)
+    try:
+        updated_at = public_bucket.Object(get_tfidf_png_key(id_)).last_modified
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+            return None
+        raise
+    _, _, checked_at = get_manifest_from_s3().get(id_, [None] * 3)
+    if checked_at is not None:
+        updated_at = max(updated_at, datetime.datetime.fromisoformat(checked_at))
+    return updated_at.isoformat()
+
+
+# 描画に使われる上位の単語と重みを記事ごとに残しておく
+# WordCloudはmax_words以降の単語を使わないので、wc_configだけ変えたときは
+# TFとIDFを読み直さずにここから描き直せる
+tfidf_terms_count = tfidf_digest_words
+
+
+def get_top_terms(tf_idf, count=tfidf_terms_count):
+    top = sorted(tf_idf.items(), key=lambda x: -x[1])[:count]
+    return list(map(lambda x: [x[0], float(f"{x[1]:.6g}")], top))
+
+
+def put_tfidf_terms_to_s3(id_, tf_idf, digest):
+    body = {
+        "id": id_,
+        "updatedAt": now_isoformat(),
+        "digest": digest,
+        "terms": get_top_terms(tf_idf),
+    }
+    private_bucket.put_object(
+        Body=json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode(
+            "utf-8"
+        ),
+        Key=get_tfidf_terms_key(id_),
     )
-    return words
+    return body
+
+
+def get_tfidf_terms_from_s3(id_):
+    body = get_object_body(get_tfidf_terms_key(id_))
+    if body is None:
+        return None
+    return json.loads(body)
+
+
+def get_saved_terms(terms):
+    # 以前は単語の無い記事に仮の単語を保存していたので取り除く
+    return list(filter(lambda x: x[0] != placeholder_term, terms["terms"]))
+
+
+def get_tfidf_terms(id_, limit=None):
+    # 保存済みのものが無ければTFとIDFから計算して保存する
+    terms = get_tfidf_terms_from_s3(id_)
+    if terms is None:
+        tf_words = get_tf_from_s3(id_)
+        if tf_words is None:
+            # TFがまだ無い記事(新規、削除済み)は空で返し、保存はしない
+            return {"id": id_, "updatedAt": None, "digest": None, "terms": []}
+        tf_idf = get_tf_idf(id_, get_idf_from_s3(), tf_words)
+        terms = put_tfidf_terms_to_s3(id_, tf_idf, get_tfidf_digest(tf_idf))
+    terms["terms"] = get_saved_terms(terms)[:limit]
+    return terms
+
 
+def get_tf_idf_from_terms(id_, idf_table=None):
+    terms = get_tfidf_terms_from_s3(id_)
+    if terms is None:
+        # 上位の単語が未保存の記事はTFとIDFから計算する
+        return get_tf_idf(id_, idf_table or get_idf_from_s3())
+    return dict(get_saved_terms(terms))
 
-def update_tf_idf_png(id_):
-    idf_map = get_idf_from_s3()
 
-    tf_tsv_key = get_tf_tsv_key(id_)
-    tf_obj = private_bucket.Object(tf_tsv_key)
-    ret = tf_obj.get()
-    tf_words = dict(
+def update_tf_idf_png(id_, rerender=False, tf_words=None):
+    if rerender:
+        tf_idf = get_tf_idf_from_terms(id_)
+    else:
+        tf_idf = get_tf_idf(id_, get_idf_from_s3(), tf_words)
+    if tf_idf is None:
+        logging.info(f"tf_idf_png [{id_}] tf not found. skip.")
+        return
+    digest = get_tfidf_digest(tf_idf)
+    if digest == get_tfidf_png_digest(id_):
+        logging.info(f"tf_idf_png [{id_}] unchanged. skip.")
+        action_metrics.add("Unchanged")
+        return
+
+    with action_metrics.stage("Render"):
+        start = time.perf_counter()
+        png = get_renderer().render_png(get_render_input(tf_idf))
+        logging.info(f"render [{id_}]: {time.perf_counter() - start:.3f}s")
+    with action_metrics.stage("Put"):
+        put_tfidf_png_to_s3(id_, png, digest)
+        if not rerender:
+            put_tfidf_terms_to_s3(id_, tf_idf, digest)
+    action_metrics.add("Rendered")
+    action_metrics.add("PngBytes", len(png))
+    logging.info("done.")
+
+
+def update_tf_idf_png_from_note(id_):
+    # unfurl用: TFは保存せずに本文から描画する
+    # TFとdf.jsonを書き換えるのは同時に1つしか動かない更新の実行だけにして、
+    # 並行した読み書きで文書頻度が狂わないようにする。
+    # TFとdf.jsonはwebhookで始まる更新の実行が後から反映する
+    result = gql_client.execute(note_from_id, variable_values={"id": id_})
+    word_count, _, _ = count_html_words(result["note"]["contentHtml"])
+    num_words = sum(word_count.values())
+    tf_words = dict((k, v / num_words) for k, v in word_count.items())
+    update_tf_idf_png(id_, tf_words=tf_words)
+
+
+render_processes = int(os.environ.get("RENDER_PROCESSES", "0")) or os.cpu_count()
+
+
+def render_png_worker(items, conn):
+    try:
+        renderer = get_renderer()
+        for id_, tf_idf in items:
+            png = renderer.render_png(get_render_input(tf_idf))
+            conn.send(("png", id_, png))
+    except Exception:
+        # 例外はpickleできるとは限らないのでトレースバックを文字列で送る
+        conn.send(("error", None, traceback.format_exc()))
+    else:
+        conn.send(None)
+    finally:
+        conn.close()
+
+
+def iter_rendered_pngs(workers):
+    conns = dict((conn, process) for process, conn in workers)
+    while conns:
+        for conn in multiprocessing.connection.wait(list(conns)):
+            try:
+                result = conn.recv()
+            except EOFError:
+                process = conns[conn]
+                process.join()
+                raise RuntimeError(f"render process exited: {process.exitcode}")
+            if result is None:
+                del conns[conn]
+            elif result[0] == "error":
+                raise RuntimeError(f"render process failed:\n{result[2]}")
+            else:
+                yield result[1], result[2]
+
+
+@contextlib.contextmanager
+def render_pngs(items, num_processes):
+    # LambdaではPoolやQueueが使えない(/dev/shmが無い)のでProcessとPipeで分ける
+    # fork時点のフォントキャッシュは子プロセスに引き継がれる
+    # スレッドが動いている最中にforkしないよう、スレッドプールより先に呼ぶ
+    get_renderer()
+    workers = []
+    try:
+        for i in range(num_processes):
+            parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(
+                target=render_png_worker, args=(items[i::num_processes], child_conn)
+            )
+            process.start()
+            child_conn.close()
+            workers.append((process, parent_conn))
+        yield iter_rendered_pngs(workers)
+    finally:
+        # 途中で失敗しても残りの子プロセスを止めて回収する
+        for process, conn in workers:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+            conn.close()
+
+
+def update_tf_idf_png_batch(id_list, rerender=False):
+    """描画済み(変更なしを含む)の記事のidを返す。TFが無い記事は含めない"""
+    start = time.perf_counter()
+    idf_table = None if rerender else get_idf_from_s3()
+
+    def get_changed_tf_idf(id_):
+        # (tf_idf, digest, 描き直すか) TFが無ければNone
+        if rerender:
+            tf_idf = get_tf_idf_from_terms(id_)
+        else:
+            tf_idf = get_tf_idf(id_, idf_table)
+        if tf_idf is None:
+            return None
+        digest = get_tfidf_digest(tf_idf)
+        if digest == get_tfidf_png_digest(id_):
+            return tf_idf, digest, False
+        return tf_idf, digest, True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        results = dict(zip(id_list, executor.map(get_changed_tf_idf, id_list)))
+    # enumerateの後にKibelaで削除された記事などはTFが無いので飛ばす
+    fresh_ids = [id_ for id_, result in results.items() if result is not None]
+    changed = dict((id_, results[id_]) for id_ in fresh_ids if results[id_][2])
+    tf_idf_list = [(id_, result[0]) for id_, result in changed.items()]
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    num_processes = 0
+    if tf_idf_list:
+        # 全部変更なしならwordcloudのimportも子プロセスも要らない
+        num_processes = min(render_processes, len(tf_idf_list))
+        with render_pngs(tf_idf_list, num_processes) as pngs:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+                futures = [
+                    executor.submit(put_tfidf_png_to_s3, id_, png, changed[id_][1])
+                    for id_, png in pngs
+                ]
+                if not rerender:
+                    futures.extend(
+                        executor.submit(
+                            put_tfidf_terms_to_s3, id_, tf_idf, changed[id_][1]
+                        )
+                        for id_, tf_idf in tf_idf_list
+                    )
+                for future in futures:
+                    future.result()
+    render_time = time.perf_counter() - start
+    logger.info(
+        f"update_tf_idf_png_batch notes={len(id_list)} changed={len(tf_idf_list)} "
+        f"missing={len(id_list) - len(fresh_ids)} processes={num_processes} "
+        f"load={load_time:.3f}s render+put={render_time:.3f}s"
+    )
+    action_metrics.add_times(Load=load_time, RenderPut=render_time)
+    action_metrics.add("Rendered", len(tf_idf_list))
+    action_metrics.add("Unchanged", len(fresh_ids) - len(tf_idf_list))
+    action_metrics.add("Missing", len(id_list) - len(fresh_ids))
+    return fresh_ids
+
+
+# 記事ごとの関連記事の件数。0なら関連記事を出さない
+related_notes_count = int(os.environ.get("RELATED_NOTES", "5"))
+related_index_key = "related/index.npz"
+
+
+def get_related_index_from_s3():
+    return get_object_if_changed(
+        related_index_key, related_notes.RelatedIndex.from_bytes
+    )
+
+
+def put_related_index_to_s3(index):
+    ret = s3_client.put_object(
+        Bucket=private_bucket_name, Key=related_index_key, Body=index.to_bytes()
+    )
+    _object_cache[related_index_key] = (ret["ETag"], index)
+
+
+def get_tfidf_vector(id_):
+    terms = get_tfidf_terms_from_s3(id_)
+    if terms is None:
+        return None
+    terms = get_saved_terms(terms)
+    if not terms:
+        return None
+    words = list(map(lambda x: x[0], terms))
+    weights = np.fromiter(map(lambda x: x[1], terms), dtype="f8", count=len(words))
+    return tfidf_format.term_ids(words), weights
+
+
+def build_related_index():
+    start = time.perf_counter()
+    id_list = list(
         map(
-            lambda line: to_f_map(line.decode("utf-8").split("\t")),
-            ret["Body"].iter_lines(),
+            lambda x: os.path.splitext(x["Key"][len("tfidf_terms/") :])[0],
+            list_private_objects("tfidf_terms/"),
         )
     )
-    tf_idf = {}
-    for word, tf_freq in tf_words.items():
-        idf = idf_map.get(word, 0.0)
-        tf_idf[word] = tf_freq * idf
-
-    if len(tf_idf) == 0:
-        tf_idf["?"] = 1.0
-
-    wc = WordCloud(**wc_config)
-    wc.generate_from_frequencies(tf_idf)
-    wc_img = wc.to_image()
-    logging.info(f"{wc_img=} {wc_img.size}")
-    with io.BytesIO() as bio:
-        wc_img.save(bio, format="png")
-        bio.seek(0)
-        pngkey = get_tfidf_png_key(id_)
-        public_bucket.upload_fileobj(bio, pngkey)
-        logging.info(f"done.")
+    vectors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=idf_workers) as executor:
+        for id_, future in iter_bounded(
+            executor, get_tfidf_vector, id_list, idf_workers * 4
+        ):
+            vector = future.result()
+            if vector is not None:
+                vectors.append((id_, *vector))
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = related_notes.RelatedIndex.build(vectors, related_notes_count)
+    put_related_index_to_s3(index)
+    logger.info(
+        f"build_related_index notes={len(index)} "
+        f"load={load_time:.3f}s build+put={time.perf_counter() - start:.3f}s"
+    )
+
+
+def update_related_index(notes):
+    # 変わった記事と、上位に影響する記事の行だけ計算し直す
+    # notes: [(id, isArchived)]
+    index = get_related_index_from_s3()
+    if index is None:
+        build_related_index()
+        return
+    start = time.perf_counter()
+    affected = 0
+    for id_, is_archived in notes:
+        vector = None if is_archived else get_tfidf_vector(id_)
+        if vector is None:
+            affected += index.remove(id_)
+        else:
+            affected += index.update(id_, *vector)
+    put_related_index_to_s3(index)
+    logger.info(
+        f"update_related_index notes={len(notes)} affected={affected} "
+        f"{time.perf_counter() - start:.3f}s"
+    )
+
+
+def get_related_notes_block(id_):
+    index = get_related_index_from_s3()
+    related = index.related(id_) if index is not None else []
+    if not related:
+        return None
+    notes = get_notes_from_ids(
+        list(map(lambda x: x[0], related)), fields="id title url"
+    )
+    links = " / ".join(
+        map(lambda n: f"""<{n["url"]}|{n["title"]}>""", filter(None, notes))
+    )
+    return {
+        "type": "context",
+        "elements": [{"type": "mrkdwn", "text": f"""*関連記事:* {links}"""}],
+    }
 
 
 def update_tf_idf_s3(id_, content_updated_at):
     logger.info(f"update_tf_idf_s3 [{id_}] [{content_updated_at}]")
-    tf_tsv_key = get_tf_tsv_key(id_)
-    tf_idf_png_key = get_tfidf_png_key(id_)
     need_update = True
     try:
-        obj = public_bucket.Object(tf_idf_png_key)
-        last_modified = obj.last_modified
-        update_datetime = datetime.datetime.fromisoformat(content_updated_at)
-        if update_datetime <= last_modified:
+        if not is_stale(content_updated_at, get_tfidf_png_updated_at(id_)):
             need_update = False
     except Exception as e:
         logger.info(f"update_tf_idf_png[{id_}]: Exception: {e}")
@@ -371,46 +1723,75 @@ def update_tf_idf_s3(id_, content_updated_at):
     return
 
 
-def get_note_id_from_url(url):
-    result = gql_client.execute(note_id_from_path, variable_values={"path": url})
+def get_note_id_from_url(url, with_detail=False):
+    query = note_detail_from_path if with_detail else note_id_from_path
+    result = gql_client.execute(query, variable_values={"path": url})
     ret = result["note"]
     id_ = ret["id"]
-    logger.info(f"{ret['contentUpdatedAt']=} {type(ret['contentUpdatedAt'])}")
-    tf_tsv_key = get_tf_tsv_key(id_)
-    tf_tsv_obj = private_bucket.Object(tf_tsv_key)
-    try:
-        tf_tsv_updated_at = tf_tsv_obj.last_modified.isoformat()
-    except:
-        tf_tsv_updated_at = None
-    ret["tfTsvUpdatedAt"] = tf_tsv_updated_at
-
-    tfidf_png_key = get_tfidf_png_key(id_)
-    tfidf_png_obj = public_bucket.Object(tfidf_png_key)
-    try:
-        tfidf_png_updated_at = tfidf_png_obj.last_modified.isoformat()
-    except:
-        tfidf_png_updated_at = None
-    ret["tfidfPngUpdatedAt"] = tfidf_png_updated_at
+    logger.debug(f"{ret['contentUpdatedAt']=} {type(ret['contentUpdatedAt'])}")
+    ret["tfTsvUpdatedAt"] = get_tf_updated_at(id_)
+    ret["tfidfPngUpdatedAt"] = get_tfidf_png_updated_at(id_)
 
     return ret
 
 
-def unfurl_from_id(id_):
+def get_unfurl_cache_key(url):
+    # bolt-app側と同じキーを使う
+    # /notes/N と /@user/N は同じ記事なので、末尾の記事番号があればそれで引く
+    path = urllib.parse.urlparse(url).path.strip("/")
+    number = path.rsplit("/", 1)[-1]
+    if number.isdigit():
+        return f"unfurl/notes/{number}.json"
+    return f"unfurl/{path}.json"
+
+
+def put_unfurl_cache(url, content_updated_at, fetched_at, attachement):
+    # 記事を取得した後にwebhookで無効にされていたら古い内容かもしれないので書かない
+    # すでに新しい内容のキャッシュがあるときも書かない
+    try:
+        current = json.loads(get_object_body(get_unfurl_cache_key(url)) or "{}")
+    except ValueError:
+        current = {}
+    if current.get("invalidatedAt", 0) > fetched_at:
+        logger.info(f"unfurl cache [{url}] invalidated after fetch. skip.")
+        return
+    if current.get("contentUpdatedAt") is not None and is_stale(
+        current["contentUpdatedAt"], content_updated_at
+    ):
+        logger.info(f"unfurl cache [{url}] has newer content. skip.")
+        return
+    cache = {
+        "url": url,
+        "contentUpdatedAt": content_updated_at,
+        "cachedAt": time.time(),
+        "attachement": attachement,
+    }
+    private_bucket.put_object(
+        Body=json.dumps(cache, ensure_ascii=False).encode("utf-8"),
+        Key=get_unfurl_cache_key(url),
+    )
+
+
+def unfurl_from_id(id_, with_related=related_notes_count > 0):
     result = gql_client.execute(note_detail_from_id, variable_values={"id": id_})
-    logging.info(f"note_detail_from_id: {result=}")
-    note = result["note"]
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"note_detail_from_id: {result=}")
+    return unfurl_from_note(result["note"], with_related)
+
+
+def unfurl_from_note(note, with_related=related_notes_count > 0):
     tfidf_png_url = get_tfidf_png_url(note["id"])
     logging.info(f"{tfidf_png_url=}")
 
     folder_name = (
-        f"""<https://{kibela_team}.kibe.la{note["folder"]["path"]}|{note["folder"]["fullName"]}>"""
+        f"""<https://{get_kibela_team()}.kibe.la{note["folder"]["path"]}|{note["folder"]["fullName"]}>"""
         if "folder" in note and note["folder"]
         else "未設定"
     )
     groups = "/".join(
         list(
             map(
-                lambda g: f"""<https://{kibela_team}.kibe.la{g["path"]}|{g["name"]}>""",
+                lambda g: f"""<https://{get_kibela_team()}.kibe.la{g["path"]}|{g["name"]}>""",
                 note["groups"],
             )
         )
@@ -467,17 +1848,62 @@ def unfurl_from_id(id_):
             },
         ]
     }
+    if with_related:
+        # 関連記事は前計算した索引を引くだけ。取れなくてもunfurlは返す
+        try:
+            related_block = get_related_notes_block(note["id"])
+        except Exception as e:
+            logger.error(f"related notes [{note['id']}] Exception: {e}")
+            related_block = None
+        if related_block:
+            attachement["blocks"].append(related_block)
     return attachement
 
 
 def handler(event, context):
-    logger.info(f"step_handler {event=} {context=}")
+    # イベントはノートの本文やunfurlの結果を含んで大きくなるのでDEBUGでだけ出す
     action = event["action"]
+    logger.info(f"step_handler action={action} id={event.get('id')}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"step_handler {event=} {context=}")
+    action_metrics.begin(action)
+    if event.get("id"):
+        action_metrics.set_property("NoteId", event["id"])
+    try:
+        return handle_action(action, event)
+    finally:
+        action_metrics.flush()
+        log_kibela_latency()
+        if profile_startup:
+            logger.info(f"startup profile: {json.dumps(startup_profile)}")
+
+
+def handle_action(action, event):
     if action == "enumerate_notes":
-        event["id_list"] = get_page_ids()
+        if "chunk_size" not in event:
+            event["id_list"] = get_page_ids()
+        elif event.get("use_manifest", False):
+            event["chunk_keys"], event["idfOutdated"] = enumerate_stale_notes(
+                event["chunk_size"]
+            )
+        else:
+            event["chunk_keys"] = put_note_chunks(iter_notes(), event["chunk_size"])
+    elif action == "enumerate_urls":
+        event["chunk_keys"], event["idfOutdated"] = put_url_chunks(
+            event["urls"], event.get("chunk_size", 100)
+        )
     elif action == "get_note_from_url":
         url = event["url"]
-        note = get_note_id_from_url(url)
+        with_detail = event.get("with_detail", False)
+        # unfurlのキャッシュを書くときに、この後で無効にされていないか見る
+        event["fetchedAt"] = time.time()
+        note = get_note_id_from_url(url, with_detail)
+        if with_detail:
+            event["note"] = dict(
+                (k, v)
+                for k, v in note.items()
+                if k not in ["tfTsvUpdatedAt", "tfidfPngUpdatedAt"]
+            )
         event["id"] = note["id"]
         event["contentUpdatedAt"] = note["contentUpdatedAt"]
         event["tfTsvUpdatedAt"] = note["tfTsvUpdatedAt"]
@@ -487,17 +1913,107 @@ def handler(event, context):
         id_ = event["id"]
         content_updated_at = event["contentUpdatedAt"]
         is_archived = event["isArchived"]
-        update_tf(id_)
+        update_tf(id_, incremental=event.get("incremental", False))
+    elif action == "update_tf_batch":
+        # 書庫化された記事もupdate_tfと同様にTFは作る
+        chunk = get_note_chunk(event["chunk_key"])
+        notes = list(filter(lambda x: x.get("needTf", True), chunk))
+        written_ids = set(
+            update_tf_batch(
+                list(map(lambda x: x["id"], notes)),
+                incremental=event.get("incremental", False),
+            )
+        )
+        # 書けなかった記事は次のenumerateでやり直す
+        tf_tsv_updated_at = now_isoformat()
+        for note in filter(lambda x: x["id"] in written_ids, notes):
+            note["tfTsvUpdatedAt"] = tf_tsv_updated_at
+        put_note_chunk(event["chunk_key"], chunk)
+    elif action == "compact_tf_shards":
+        compact_tf_shards()
+    elif action == "plan_idf":
+        if event.get("idfOutdated", True):
+            event["prefix"], event["units"] = plan_idf_map_reduce(event["num_units"])
+        else:
+            event["prefix"], event["units"] = None, []
+    elif action == "map_idf":
+        map_idf_unit(event["prefix"], event["unit"])
+    elif action == "reduce_idf":
+        if event["prefix"] is not None:
+            reduce_idf(event["prefix"])
     elif action == "update_idf":
-        update_idf()
+        if event.get("idfOutdated", True):
+            update_idf(rebuild=event.get("rebuild", False))
     elif action == "update_tfidf_png":
         id_ = event["id"]
         content_updated_at = event["contentUpdatedAt"]
         is_archived = event["isArchived"]
-        if not is_archived:
+        if event.get("rerender", False):
+            if not is_archived:
+                update_tf_idf_png(id_, rerender=True)
+        elif "needPng" in event:
+            # manifestで更新要否を判定済み
+            if event["needPng"] and not is_archived:
+                update_tf_idf_png(id_)
+                event["tfidfPngUpdatedAt"] = now_isoformat()
+        elif not is_archived:
             update_tf_idf_s3(id_, content_updated_at)
+    elif action == "update_tfidf_png_from_note":
+        if not event["isArchived"]:
+            update_tf_idf_png_from_note(event["id"])
+    elif action == "update_tfidf_png_batch":
+        chunk = get_note_chunk(event["chunk_key"])
+        rerender = event.get("rerender", False)
+        notes = list(
+            filter(
+                lambda x: (rerender or x.get("needPng", True)) and not x["isArchived"],
+                chunk,
+            )
+        )
+        fresh_ids = set()
+        if notes:
+            fresh_ids = set(
+                update_tf_idf_png_batch(
+                    list(map(lambda x: x["id"], notes)), rerender=rerender
+                )
+            )
+        tfidf_png_updated_at = now_isoformat()
+        for note in filter(lambda x: x["id"] in fresh_ids, notes):
+            note["tfidfPngUpdatedAt"] = tfidf_png_updated_at
+        put_note_chunk(event["chunk_key"], chunk)
+    elif action == "get_tfidf_terms":
+        terms = get_tfidf_terms(event["id"], limit=event.get("limit"))
+        event["terms"] = terms["terms"]
+        event["tfidfTermsUpdatedAt"] = terms["updatedAt"]
+    elif action == "update_related_notes":
+        if "id" in event:
+            update_related_index([(event["id"], event.get("isArchived", False))])
+        elif event.get("incremental", False):
+            # webhookでまとめて更新した記事だけ近傍を計算し直す
+            notes = [
+                (note["id"], note["isArchived"])
+                for key in event["chunk_keys"]
+                for note in get_note_chunk(key)
+            ]
+            update_related_index(notes)
+        elif event.get("chunk_keys") or event.get("idfOutdated", True):
+            build_related_index()
+    elif action == "update_manifest":
+        update_manifest(event["chunk_keys"])
     elif action == "unfurl":
-        event["attachement"] = unfurl_from_id(event["id"])
+        if event.get("note"):
+            event["attachement"] = unfurl_from_note(event["note"])
+        else:
+            event["attachement"] = unfurl_from_id(event["id"])
+        put_unfurl_cache(
+            event["url"],
+            event.get("contentUpdatedAt"),
+            event.get("fetchedAt", 0),
+            event["attachement"],
+        )
     else:
         logger.info(f"unknown action[{event['action']}]")
     return event
+
+
+record_startup("app", _import_start)
@@ -0,0 +1,182 @@
+"""contentHtmlをブロック単位のテキストにして少しずつ取り出す
+
+html_text.extract_textは文書全体のテキストを1つの文字列にするので、
+長い議事録や貼り付けた表だとメモリを使い、Sudachiの入力サイズの上限にも当たる。
+ここではlxmlのHTMLPullParserでHTMLを少しずつ読み、ブロック要素の開始・終了のたびに
+それまでのテキストを返し、読み終えた要素は空にする。
+テキストはチャンクにまとめて形態素解析する。
+
+テキストの区切り方はhtml_textに合わせている。
+- script/styleなどhtml_textのcleanerが消すタグとskip_tagsは中身ごと読まず、
+  前後のテキストは空白を入れずにつなぐ(cleanerが消したあとのテキストと同じ)
+- iframe/objectなどcleanerがタグだけ消すものとコメントも前後をそのままつなぐ
+- それ以外のインライン要素の前後はhtml_textと同じ規則で空白を入れる
+- ブロック要素の前後で行を分け、文書の順番に返す
+表のセルも行を分ける(html_textでは空白)。どちらも単語の区切りになる。
+"""
+import re
+
+import lxml.etree
+from html_text import DOUBLE_NEWLINE_TAGS, NEWLINE_TAGS
+
+# 表のセルも行を分ける。html/bodyは直下に残ったテキストのため
+BLOCK_TAGS = NEWLINE_TAGS | DOUBLE_NEWLINE_TAGS | {"td", "th", "body", "html"}
+# html_textのcleaner(scripts, style, embedded, frames, links, meta)が中身ごと消すタグ
+SKIP_TAGS = frozenset(
+    [
+        "script",
+        "style",
+        "applet",
+        "param",
+        "frame",
+        "frameset",
+        "noframes",
+        "link",
+        "meta",
+    ]
+)
+# cleanerがタグだけ消して中身を残すもの
+DROP_TAGS = frozenset(["iframe", "embed", "object", "layer"])
+
+_whitespace = re.compile(r"\s+")
+_has_trailing_whitespace = re.compile(r"\s$").search
+_has_punct_after = re.compile(r'^[,:;.!?")]').search
+_has_open_bracket_before = re.compile(r"\($").search
+
+
+def _clear(elem):
+    # 後で読むのでtailは残す
+    tail = elem.tail
+    elem.clear()
+    elem.tail = tail
+
+
+def _text_before(elem):
+    # elemの開始タグ(またはコメント)の直前のテキスト
+    previous = elem.getprevious()
+    if previous is not None:
+        return previous.tail
+    parent = elem.getparent()
+    return parent.text if parent is not None else None
+
+
+def _text_before_end(elem):
+    # elemの終了タグの直前のテキスト
+    return elem[-1].tail if len(elem) else elem.text
+
+
+class _Line:
+    """html_text.etree_to_textと同じ規則でテキストをつなぐ"""
+
+    def __init__(self):
+        self.parts = []
+        self.prev = None
+        self.pending = []
+
+    def append(self, text):
+        # タグを挟まずに続くテキスト(消したタグやコメントの前後)はつないでおく
+        if text:
+            self.pending.append(text)
+
+    def flush(self):
+        raw = "".join(self.pending)
+        self.pending = []
+        text = _whitespace.sub(" ", raw.strip())
+        if not text:
+            return
+        if self.parts and self._space_before(text):
+            self.parts.append(" ")
+        self.parts.append(text)
+        self.prev = raw
+
+    def _space_before(self, text):
+        if not _has_trailing_whitespace(self.prev):
+            if _has_punct_after(text) or _has_open_bracket_before(self.prev):
+                return False
+        return True
+
+    def pop(self):
+        self.flush()
+        text = "".join(self.parts)
+        self.parts = []
+        self.prev = None
+        return text
+
+
+def iter_blocks(html, skip_tags=SKIP_TAGS, feed_size=1 << 16):
+    """ブロック要素で区切ったテキストを文書の順番に返す"""
+    if not html.strip():
+        return
+    parser = lxml.etree.HTMLPullParser(events=("start", "end", "comment", "pi"))
+    line = _Line()
+    skipping = 0
+
+    def handle(events):
+        nonlocal skipping
+        for event, elem in events:
+            tag = elem.tag
+            if event in ("comment", "pi"):
+                if not skipping:
+                    line.append(_text_before(elem))
+                continue
+            if event == "start":
+                if not skipping:
+                    line.append(_text_before(elem))
+                if tag in skip_tags:
+                    skipping += 1
+                    continue
+            elif tag in skip_tags:
+                skipping -= 1
+                _clear(elem)
+                continue
+            elif not skipping:
+                line.append(_text_before_end(elem))
+            if skipping or tag in DROP_TAGS:
+                continue
+            if tag in BLOCK_TAGS:
+                text = line.pop()
+                if text:
+                    yield text
+                if event == "end":
+                    # 読み終えたブロックは消してメモリを抑える
+                    _clear(elem)
+            else:
+                line.flush()
+
+    for i in range(0, len(html), feed_size):
+        parser.feed(html[i : i + feed_size])
+        yield from handle(parser.read_events())
+    parser.close()
+    yield from handle(parser.read_events())
+    text = line.pop()
+    if text:
+        yield text
+
+
+def split_text(text, size):
+    """size文字以下に区切る。なるべく句点か空白の後で切る"""
+    start = 0
+    while len(text) - start > size:
+        end = start + size
+        cut = max(text.rfind("。", start, end), text.rfind(" ", start, end))
+        cut = cut + 1 if cut >= start else end
+        yield text[start:cut]
+        start = cut
+    if start < len(text):
+        yield text[start:]
+
+
+def iter_chunks(html, chunk_size, skip_tags=SKIP_TAGS):
+    """ブロックのテキストをchunk_size文字程度にまとめて返す"""
+    chunk = []
+    length = 0
+    for block in iter_blocks(html, skip_tags):
+        for text in split_text(block, chunk_size):
+            if chunk and length + len(text) > chunk_size:
+                yield "\n".join(chunk)
+                chunk = []
+                length = 0
+            chunk.append(text)
+            length += len(text) + 1
+    if chunk:
+        yield "\n".join(chunk)
@@ -0,0 +1,140 @@
+"""handlerのactionごとの計測値をCloudWatch Embedded Metric Formatで出す
+
+    metrics.begin(action)
+    with metrics.stage("Fetch"):
+        ...
+    metrics.add("Words", len(words))
+    metrics.flush()
+
+flushするとEMFのJSONを1行stdoutに書き、CloudWatch Logsがメトリクスとして取り込む。
+sink_pathを指定したときは同じJSONをそのファイルにも追記する(ローカルでの計測用)。
+"""
+import contextlib
+import json
+import sys
+import threading
+import time
+
+# メトリクス名の末尾で単位を決める
+_units = [
+    ("Time", "Milliseconds"),
+    ("Bytes", "Bytes"),
+]
+
+
+def body_size(body):
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    # boto3はBodyをファイルオブジェクトに包んで渡してくる
+    try:
+        position = body.tell()
+        size = body.seek(0, 2)
+        body.seek(position)
+        return size - position
+    except Exception:
+        return 0
+
+
+def unit_of(name):
+    for suffix, unit in _units:
+        if name.endswith(suffix):
+            return unit
+    return "Count"
+
+
+class Metrics:
+    def __init__(self, namespace, enabled=True, sink_path=None):
+        self.namespace = namespace
+        self.enabled = enabled
+        self.sink_path = sink_path
+        self._lock = threading.Lock()
+        self.begin(None)
+
+    def begin(self, action):
+        with self._lock:
+            self.action = action
+            self.values = {}
+            self.properties = {}
+            self.start = time.perf_counter()
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def add_time(self, name, seconds):
+        self.add(f"{name}Time", seconds * 1000)
+
+    def add_times(self, **seconds):
+        for name, value in seconds.items():
+            self.add_time(name, value)
+
+    def set_property(self, name, value):
+        # 検索用にログには残すがメトリクスにはしない値
+        with self._lock:
+            self.properties[name] = value
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def to_emf(self):
+        with self._lock:
+            values = dict(self.values)
+            properties = dict(self.properties)
+        values["Time"] = (time.perf_counter() - self.start) * 1000
+        doc = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [["Action"]],
+                        "Metrics": [
+                            {"Name": name, "Unit": unit_of(name)}
+                            for name in sorted(values)
+                        ],
+                    }
+                ],
+            },
+            "Action": self.action or "unknown",
+        }
+        doc.update(properties)
+        doc.update(values)
+        return doc
+
+    def flush(self):
+        if not self.enabled and self.sink_path is None:
+            return None
+        doc = self.to_emf()
+        line = json.dumps(doc, ensure_ascii=False, separators=(",", ":"))
+        if self.enabled:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+        if self.sink_path is not None:
+            with open(self.sink_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        self.begin(None)
+        return doc
+
+    def instrument_boto3_client(self, client, prefix="S3"):
+        """boto3クライアントの呼び出し回数と転送バイト数を数える"""
+
+        def before_call(model, params, **kwargs):
+            self.add(f"{prefix}Calls")
+            self.add(f"{prefix}{model.name}Calls")
+            body = params.get("body")
+            if body:
+                self.add(f"{prefix}SentBytes", body_size(body))
+
+        def after_call(model, parsed, **kwargs):
+            length = parsed.get("ContentLength")
+            if length and model.name == "GetObject":
+                self.add(f"{prefix}ReceivedBytes", length)
+
+        client.meta.events.register("before-call", before_call)
+        client.meta.events.register("after-call", after_call)
+        return client
@@ -0,0 +1,236 @@
+"""TF*IDFベクトルによる関連記事の索引
+
+記事ごとのTF*IDF上位の単語(tfidf_terms/{id}.json)を疎ベクトルとして持ち、
+コサイン類似度の上位top_n件を記事ごとに前計算しておく。
+unfurlでは索引を引くだけで類似度は計算しない。
+
+ベクトルはCSRと同じ形(indptr, term_ids, weights)で持ち、重みはL2正規化済み。
+類似度は単語IDでソートした転置リストを引いて、行のブロックごとに
+numpy.bincountで内積を足し合わせる。
+"""
+import io
+
+import numpy as np
+
+# 1ブロックで作る類似度行列の要素数の上限
+block_cells = 1 << 22
+
+
+def normalize(indptr, weights):
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    norms = np.sqrt(
+        np.bincount(rows, weights=weights * weights, minlength=len(indptr) - 1)
+    )
+    norms[norms == 0] = 1.0
+    return (weights / norms[rows]).astype("<f4")
+
+
+class _Postings:
+    """単語IDでソートした(単語ID, 行, 重み)の並び"""
+
+    def __init__(self, indptr, term_ids, weights):
+        self.num_rows = len(indptr) - 1
+        rows = np.repeat(np.arange(self.num_rows), np.diff(indptr))
+        order = np.argsort(term_ids, kind="stable")
+        self.term_ids = term_ids[order]
+        self.rows = rows[order]
+        self.weights = weights[order]
+
+    def dot(self, q_rows, q_term_ids, q_weights, num_q):
+        """クエリのベクトル(行番号0..num_q-1)と全行の内積を(num_q, num_rows)で返す"""
+        start = np.searchsorted(self.term_ids, q_term_ids, side="left")
+        lengths = np.searchsorted(self.term_ids, q_term_ids, side="right") - start
+        total = int(lengths.sum())
+        if total == 0:
+            return np.zeros((num_q, self.num_rows), dtype="f8")
+        ends = np.cumsum(lengths)
+        index = np.arange(total) + np.repeat(start - ends + lengths, lengths)
+        flat = np.repeat(q_rows, lengths) * self.num_rows + self.rows[index]
+        products = np.repeat(q_weights, lengths) * self.weights[index]
+        return np.bincount(
+            flat, weights=products, minlength=num_q * self.num_rows
+        ).reshape(num_q, self.num_rows)
+
+
+def _top_n(similarities, self_rows, top_n):
+    num_q, num_rows = similarities.shape
+    similarities[np.arange(num_q), self_rows] = 0.0
+    neighbors = np.full((num_q, top_n), -1, dtype="<i4")
+    scores = np.zeros((num_q, top_n), dtype="<f4")
+    k = min(top_n, num_rows)
+    if k == 0:
+        return neighbors, scores
+    part = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(similarities, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    part = np.take_along_axis(part, order, axis=1)
+    part_scores = np.take_along_axis(part_scores, order, axis=1)
+    found = part_scores > 0
+    neighbors[:, :k] = np.where(found, part, -1)
+    scores[:, :k] = np.where(found, part_scores, 0.0)
+    return neighbors, scores
+
+
+class RelatedIndex:
+    def __init__(self, ids, indptr, term_ids, weights, neighbors, scores):
+        self.ids = list(ids)
+        self.indptr = indptr
+        self.term_ids = term_ids
+        self.weights = weights
+        self.neighbors = neighbors
+        self.scores = scores
+        self.rows = dict((id_, i) for i, id_ in enumerate(self.ids))
+
+    @property
+    def top_n(self):
+        return self.neighbors.shape[1]
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, vectors, top_n):
+        """vectorsは(id, term_ids, weights)の並び"""
+        vectors = list(vectors)
+        indptr = np.zeros(len(vectors) + 1, dtype="<i8")
+        np.cumsum([len(v[1]) for v in vectors], out=indptr[1:])
+        term_ids = np.concatenate(
+            [np.zeros(0, dtype="<u8")]
+            + [np.asarray(v[1], dtype="<u8") for v in vectors]
+        )
+        weights = np.concatenate(
+            [np.zeros(0)] + [np.asarray(v[2], dtype="f8") for v in vectors]
+        )
+        index = cls(
+            map(lambda v: v[0], vectors),
+            indptr,
+            term_ids,
+            normalize(indptr, weights),
+            np.full((len(vectors), top_n), -1, dtype="<i4"),
+            np.zeros((len(vectors), top_n), dtype="<f4"),
+        )
+        index.recompute(np.arange(len(vectors)))
+        return index
+
+    def recompute(self, rows):
+        """指定した行の上位top_n件を計算し直す"""
+        postings = _Postings(self.indptr, self.term_ids, self.weights)
+        block = max(1, block_cells // max(1, len(self.ids)))
+        for i in range(0, len(rows), block):
+            block_rows = np.asarray(rows[i : i + block])
+            starts = self.indptr[block_rows]
+            lengths = self.indptr[block_rows + 1] - starts
+            index = np.arange(int(lengths.sum())) + np.repeat(
+                starts - np.cumsum(lengths) + lengths, lengths
+            )
+            q_rows = np.repeat(np.arange(len(block_rows)), lengths)
+            similarities = postings.dot(
+                q_rows, self.term_ids[index], self.weights[index], len(block_rows)
+            )
+            self.neighbors[block_rows], self.scores[block_rows] = _top_n(
+                similarities, block_rows, self.top_n
+            )
+
+    def _remove_row(self, row):
+        start, end = self.indptr[row], self.indptr[row + 1]
+        self.term_ids = np.concatenate([self.term_ids[:start], self.term_ids[end:]])
+        self.weights = np.concatenate([self.weights[:start], self.weights[end:]])
+        self.indptr = np.concatenate(
+            [self.indptr[:row], self.indptr[row + 1 :] - (end - start)]
+        )
+        # 行番号を詰め、消えた行への参照は-1にする
+        remap = np.arange(-1, len(self.ids), dtype="<i4")
+        remap[row + 1] = -1
+        remap[row + 2 :] -= 1
+        self.neighbors = remap[np.delete(self.neighbors, row, axis=0) + 1]
+        self.scores = np.delete(self.scores, row, axis=0)
+        del self.ids[row]
+        self.rows = dict((id_, i) for i, id_ in enumerate(self.ids))
+
+    def _affected_rows(self, row, similarities):
+        # 上位に入っていた行と、新しい類似度が上位の最小値を超える行だけ計算し直す
+        referenced = np.any(self.neighbors == row, axis=1)
+        full = self.neighbors[:, -1] >= 0
+        threshold = np.where(full, self.scores[:, -1], 0.0)
+        return np.flatnonzero(referenced | (similarities > threshold))
+
+    def remove(self, id_):
+        """記事を消し、影響を受けた行数を返す"""
+        if id_ not in self.rows:
+            return 0
+        row = self.rows[id_]
+        referenced = np.flatnonzero(np.any(self.neighbors == row, axis=1))
+        self._remove_row(row)
+        affected = np.where(referenced > row, referenced - 1, referenced)
+        self.recompute(affected)
+        return len(affected)
+
+    def update(self, id_, term_ids, weights):
+        """記事のベクトルを差し替え、影響を受けた行数を返す"""
+        affected = set()
+        if id_ in self.rows:
+            row = self.rows[id_]
+            referenced = np.flatnonzero(np.any(self.neighbors == row, axis=1))
+            self._remove_row(row)
+            affected.update(
+                np.where(referenced > row, referenced - 1, referenced).tolist()
+            )
+        term_ids = np.asarray(term_ids, dtype="<u8")
+        weights = normalize(
+            np.array([0, len(term_ids)]), np.asarray(weights, dtype="f8")
+        )
+        row = len(self.ids)
+        self.ids.append(id_)
+        self.rows[id_] = row
+        self.indptr = np.append(self.indptr, self.indptr[-1] + len(term_ids))
+        self.term_ids = np.concatenate([self.term_ids, term_ids])
+        self.weights = np.concatenate([self.weights, weights])
+        self.neighbors = np.vstack(
+            [self.neighbors, np.full((1, self.top_n), -1, dtype="<i4")]
+        )
+        self.scores = np.vstack([self.scores, np.zeros((1, self.top_n), dtype="<f4")])
+
+        postings = _Postings(self.indptr, self.term_ids, self.weights)
+        q_rows = np.zeros(len(term_ids), dtype="i8")
+        similarities = postings.dot(q_rows, term_ids, weights, 1)[0]
+        similarities[row] = 0.0
+        affected.update(self._affected_rows(row, similarities).tolist())
+        affected.add(row)
+        self.recompute(np.array(sorted(affected), dtype="i8"))
+        return len(affected)
+
+    def related(self, id_):
+        """(id, score)の並びを返す"""
+        row = self.rows.get(id_)
+        if row is None:
+            return []
+        return [
+            (self.ids[n], float(s))
+            for n, s in zip(self.neighbors[row], self.scores[row])
+            if n >= 0
+        ]
+
+    def to_bytes(self):
+        with io.BytesIO() as bio:
+            np.savez(
+                bio,
+                ids=np.array(self.ids, dtype="U"),
+                indptr=self.indptr,
+                term_ids=self.term_ids,
+                weights=self.weights,
+                neighbors=self.neighbors,
+                scores=self.scores,
+            )
+            return bio.getvalue()
+
+    @classmethod
+    def from_bytes(cls, body):
+        with np.load(io.BytesIO(body), allow_pickle=False) as data:
+            return cls(
+                data["ids"].tolist(),
+                data["indptr"],
+                data["term_ids"],
+                data["weights"],
+                data["neighbors"],
+                data["scores"],
+            )
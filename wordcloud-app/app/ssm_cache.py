@@ -0,0 +1,79 @@
+"""SSMパラメータのキャッシュ
+
+bolt-app/app/ssm_cache.pyと同じ内容。
+取得した値はttl秒の間メモリに持ち、期限が切れたら取り直す。
+cache_pathを指定すると/tmpなどにも書き出し、同じコンテナで
+プロセスが作り直されたときのSSM呼び出しを省く。
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+import boto3
+
+logger = logging.getLogger(__name__)
+
+
+class SecretsCache:
+    def __init__(self, names, ttl=300, cache_path=None, client=None):
+        self.names = list(names)
+        self.ttl = ttl
+        self.cache_path = cache_path
+        self.client = client
+        self.values = None
+        self.fetched_at = 0.0
+        self.lock = threading.Lock()
+
+    def _expired(self, fetched_at):
+        return time.time() - fetched_at > self.ttl
+
+    def _load_disk_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return False
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.info(f"ssm cache read error: {e}")
+            return False
+        if self._expired(cache["fetchedAt"]) or set(cache["values"]) != set(self.names):
+            return False
+        self.values = cache["values"]
+        self.fetched_at = cache["fetchedAt"]
+        return True
+
+    def _save_disk_cache(self):
+        if not self.cache_path:
+            return
+        fd = os.open(self.cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"fetchedAt": self.fetched_at, "values": self.values}, f)
+
+    def _fetch(self):
+        if self.client is None:
+            self.client = boto3.client("ssm")
+        response = self.client.get_parameters(Names=self.names, WithDecryption=True)
+        values = dict(map(lambda x: (x["Name"], x["Value"]), response["Parameters"]))
+        missing = set(self.names) - set(values)
+        if missing:
+            raise Exception(f"can't retrieve ssm: {sorted(missing)}")
+        self.values = values
+        self.fetched_at = time.time()
+        self._save_disk_cache()
+
+    def get(self, name):
+        with self.lock:
+            if self.values is None or self._expired(self.fetched_at):
+                if self.values is not None or not self._load_disk_cache():
+                    self._fetch()
+            return self.values[name]
+
+    def invalidate(self):
+        # 認証エラーなどでローテーションが疑われるときに次のgetで取り直す
+        with self.lock:
+            self.values = None
+            self.fetched_at = 0.0
+            if self.cache_path and os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
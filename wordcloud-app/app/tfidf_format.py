@@ -0,0 +1,104 @@
+"""TF/IDFのバイナリ形式
+
+単語はblake2bの64bitハッシュを全記事共通の単語IDとして扱う。
+どちらの形式もヘッダの後に固定長の配列が続くので、S3から読んだバッファを
+numpy.frombufferでそのまま参照できる。
+
+tf/{id}.bin
+    header (magic, version, reserved, num_terms, num_words)
+    term_ids: uint64 x num_terms (昇順)
+    counts:   uint32 x num_terms
+    words:    term_idsと同じ順で単語をNULL区切りにしたUTF-8
+
+idf.bin
+    header (magic, version, reserved, num_terms, num_docs)
+    term_ids: uint64 x num_terms (昇順)
+    idf:      float64 x num_terms
+"""
+import hashlib
+import struct
+
+import numpy as np
+
+FORMAT_VERSION = 1
+TF_MAGIC = b"KTF\0"
+IDF_MAGIC = b"KIDF"
+
+_header = struct.Struct("<4sHHII")
+
+
+def term_id(word):
+    return int.from_bytes(
+        hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+def term_ids(words):
+    return np.fromiter(map(term_id, words), dtype="<u8", count=len(words))
+
+
+def _check_header(buf, magic):
+    if len(buf) < _header.size:
+        raise ValueError("buffer too short")
+    magic_, version, _, num_terms, value = _header.unpack_from(buf, 0)
+    if magic_ != magic:
+        raise ValueError(f"bad magic: {magic_}")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"unsupported version: {version}")
+    return num_terms, value
+
+
+def encode_tf(word_count):
+    words = list(word_count)
+    ids = term_ids(words)
+    order = np.argsort(ids, kind="stable")
+    counts = np.fromiter(
+        map(lambda w: word_count[w], words), dtype="<u4", count=len(words)
+    )
+    num_words = int(counts.sum())
+    sorted_words = "\0".join(map(lambda i: words[i], order)).encode("utf-8")
+    return b"".join(
+        [
+            _header.pack(TF_MAGIC, FORMAT_VERSION, 0, len(words), num_words),
+            ids[order].tobytes(),
+            counts[order].tobytes(),
+            sorted_words,
+        ]
+    )
+
+
+def decode_tf(buf):
+    """(words, term_ids, counts, num_words)を返す。配列はbufを参照する"""
+    num_terms, num_words = _check_header(buf, TF_MAGIC)
+    offset = _header.size
+    ids = np.frombuffer(buf, dtype="<u8", count=num_terms, offset=offset)
+    offset += ids.nbytes
+    counts = np.frombuffer(buf, dtype="<u4", count=num_terms, offset=offset)
+    offset += counts.nbytes
+    words = bytes(buf[offset:]).decode("utf-8").split("\0") if num_terms else []
+    return words, ids, counts, num_words
+
+
+def encode_idf(num_docs, df):
+    words = list(df)
+    ids = term_ids(words)
+    order = np.argsort(ids, kind="stable")
+    doc_counts = np.fromiter(map(lambda w: df[w], words), dtype="<f8", count=len(words))
+    idf = np.log(num_docs / doc_counts)
+    return b"".join(
+        [
+            _header.pack(IDF_MAGIC, FORMAT_VERSION, 0, len(words), num_docs),
+            ids[order].tobytes(),
+            idf[order].tobytes(),
+        ]
+    )
+
+
+def decode_idf(buf):
+    """(term_ids, idf, num_docs)を返す。配列はbufを参照する"""
+    num_terms, num_docs = _check_header(buf, IDF_MAGIC)
+    offset = _header.size
+    ids = np.frombuffer(buf, dtype="<u8", count=num_terms, offset=offset)
+    offset += ids.nbytes
+    idf = np.frombuffer(buf, dtype="<f8", count=num_terms, offset=offset)
+    return ids, idf, num_docs
@@ -0,0 +1,40 @@
+"""warmなコンテナで使いまわすWordCloud描画
+
+WordCloudは単語を置くたびにImageFont.truetypeでフォントファイルを読み直すので、
+wordcloudモジュールが参照するImageFontをサイズごとにキャッシュするものに差し替える。
+"""
+import functools
+import io
+
+import wordcloud.wordcloud
+from PIL import ImageFont
+from wordcloud import WordCloud
+
+
+class _CachedImageFont:
+    def __getattr__(self, name):
+        return getattr(ImageFont, name)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def truetype(font=None, size=10, *args, **kwargs):
+        return ImageFont.truetype(font, size, *args, **kwargs)
+
+
+def enable_font_cache():
+    wordcloud.wordcloud.ImageFont = _CachedImageFont()
+
+
+class WordCloudRenderer:
+    def __init__(self, config):
+        enable_font_cache()
+        self.wc = WordCloud(**config)
+
+    def render(self, frequencies):
+        self.wc.generate_from_frequencies(frequencies)
+        return self.wc.to_image()
+
+    def render_png(self, frequencies):
+        with io.BytesIO() as bio:
+            self.render(frequencies).save(bio, format="png")
+            return bio.getvalue()
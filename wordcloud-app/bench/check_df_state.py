@@ -0,0 +1,107 @@
+"""差分で更新したdf.jsonと作り直した文書頻度の比較
+
+    python bench/check_df_state.py --notes 200 --rounds 3
+
+KibelaとS3はfakes.pyに差し替え、全記事のTFとdf.jsonを作ったあと、
+記事の書き換え・本文を空にする・Kibelaから消える(TFは残る)・新しい記事を混ぜた
+更新を update_tf_batch(incremental=True) で何回か反映する。
+ラウンドごとに(--shardsが1以上ならコンパクションもして)df.jsonと
+count_document_frequency(*plan_idf_rebuild()) の結果を比べ、
+一致しなければ差分を出して終了コード1で終わる。
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import pipeline_bench  # noqa: E402
+from pipeline_bench import app  # noqa: E402
+
+
+def edit_notes(rand, kibela, ids, count):
+    # 書き換え、空にする、消す、追加を混ぜて変わった記事のidを返す
+    changed = rand.sample(ids, min(count, len(ids)))
+    for i, id_ in enumerate(changed):
+        if id_ not in kibela.notes:
+            continue
+        kind = i % 4
+        if kind == 0:
+            kibela.notes[id_]["contentHtml"] = "<p></p>"
+        elif kind == 1:
+            # update_tf_batchでは飛ばされ、TFとdf.jsonは前のまま残る
+            del kibela.notes[id_]
+        else:
+            kibela.notes[id_]["contentHtml"] = pipeline_bench.make_html(
+                rand, rand.randint(1, 6)
+            )
+    new_id = f"Tm90ZS8{len(ids):06}"
+    kibela.notes[new_id] = {
+        "id": new_id,
+        "title": f"追加した記事{len(ids)}",
+        "url": f"https://bench.kibe.la/notes/{len(ids)}",
+        "contentHtml": pipeline_bench.make_html(rand, rand.randint(1, 6)),
+        "contentUpdatedAt": app.now_isoformat(),
+        "isArchived": False,
+    }
+    ids.append(new_id)
+    return changed + [new_id]
+
+
+def compare(label):
+    num_docs, df = app.get_df_state_from_s3()
+    expected_docs, expected_df = app.count_document_frequency(*app.plan_idf_rebuild())
+    df, expected_df = +Counter(df), +Counter(expected_df)
+    if num_docs == expected_docs and df == expected_df:
+        print(f"{label}: num_docs={num_docs} words={len(df)} ok")
+        return True
+    print(f"{label}: num_docs={num_docs} expected={expected_docs}")
+    print(f"  only incremental: {dict(list((df - expected_df).items())[:10])}")
+    print(f"  only rebuild:     {dict(list((expected_df - df).items())[:10])}")
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notes", type=int, default=100)
+    parser.add_argument("--paragraphs", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--changes", type=int, default=20, help="1ラウンドの更新数")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--shards", type=int, default=16, help="TF_SHARDS")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    args.fixtures = None
+
+    if not args.verbose:
+        app.logger.setLevel(logging.WARNING)
+    app.tf_shard_count = args.shards
+
+    notes = pipeline_bench.make_notes(args)
+    ids = list(map(lambda x: x["id"], notes))
+    pipeline_bench.install_fakes(notes)
+    kibela = app.gql_client
+    rand = random.Random(args.seed)
+
+    for i in range(0, len(ids), args.batch_size):
+        app.update_tf_batch(ids[i : i + args.batch_size])
+    app.update_idf(rebuild=True)
+    ok = compare("initial")
+
+    for round_no in range(args.rounds):
+        changed = edit_notes(rand, kibela, ids, args.changes)
+        for i in range(0, len(changed), args.batch_size):
+            app.update_tf_batch(changed[i : i + args.batch_size], incremental=True)
+        ok = compare(f"round {round_no + 1}") and ok
+        if args.shards > 0:
+            app.compact_tf_shards()
+            ok = compare(f"round {round_no + 1} compacted") and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
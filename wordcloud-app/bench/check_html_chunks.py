@@ -0,0 +1,111 @@
+"""html_chunks.iter_blocks と html_text.extract_text の行ごとの比較
+
+    python bench/check_html_chunks.py --docs 3000
+    python bench/check_html_chunks.py --fixtures ./corpus
+
+境界のケースと、ブロック要素・インライン要素・消されるタグ・コメントを
+ランダムに入れ子にしたHTMLを両方で読み、空行を除いた行が一致するか調べる。
+表のセルはhtml_chunksだけが行を分けるので生成するHTMLには入れない。
+一致しない文書があれば先頭のいくつかを出して終了コード1で終わる。
+"""
+import argparse
+import glob
+import os
+import random
+import sys
+
+import html_text
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import html_chunks  # noqa: E402
+
+EDGE_CASES = [
+    "",
+    "  ",
+    "<!-- only -->",
+    "plain text",
+    "<p>a<object>b</object>c</p>",
+    "<p>a<iframe>b</iframe>c</p>",
+    "<p>a<applet>b</applet>c</p>",
+    "<p>a<script>b</script>c</p>",
+    "<p>次<!-- x -->後</p>",
+    "<p>次<code>b</code>後</p>",
+    "<p>a<span>b</span>c</p>",
+    "<div>前<p>段落</p>後</div>",
+    "<p>a <b>b</b>, c</p>",
+    "<p>(<b>b</b>)</p>",
+    "<p>a<br>b</p>",
+    "<p>a<?pi x?>c</p>",
+    "<ul><li>x<ul><li>y</li></ul>z</li></ul>",
+    "<div><span>a</span><code>c</code><span>b</span></div>",
+    "<p>a<code>x</code> <b>b</b></p>",
+    "<p>a <code>x</code>b</p>",
+]
+TAGS = ["p", "div", "span", "b", "code", "blockquote", "li", "ul", "h2", "iframe"]
+TAGS += ["script", "br", "a"]
+TEXTS = ["会議", "資料", " ", "。", "(", ")", ", ", "テスト", "a", "b "]
+
+
+def make_html(rand, depth=0):
+    out = []
+    for _ in range(rand.randint(1, 4)):
+        r = rand.random()
+        if r < 0.4 or depth > 3:
+            out.append(rand.choice(TEXTS))
+        elif r < 0.5:
+            out.append("<!--c-->")
+        else:
+            tag = rand.choice(TAGS)
+            if tag == "br":
+                out.append("<br>")
+            else:
+                out.append(f"<{tag}>{make_html(rand, depth + 1)}</{tag}>")
+    return "".join(out)
+
+
+def expected_lines(html):
+    lines = map(lambda x: x.strip(), html_text.extract_text(html).split("\n"))
+    return list(filter(None, lines))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=3000)
+    parser.add_argument("--fixtures", help="*.htmlも比べるディレクトリ")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--kill-tags",
+        default="code,blockquote",
+        help="中身ごと読まないタグ(app.pyのhtml_kill_tags)",
+    )
+    parser.add_argument("--show", type=int, default=5, help="表示する不一致の数")
+    args = parser.parse_args()
+
+    kill_tags = list(filter(None, args.kill_tags.split(",")))
+    html_text.cleaner.kill_tags = kill_tags
+    skip_tags = html_chunks.SKIP_TAGS | set(kill_tags)
+
+    rand = random.Random(args.seed)
+    htmls = EDGE_CASES + [make_html(rand) for _ in range(args.docs)]
+    if args.fixtures:
+        for path in sorted(glob.glob(os.path.join(args.fixtures, "*.html"))):
+            with open(path, encoding="utf-8") as f:
+                htmls.append(f.read())
+
+    mismatches = 0
+    for html in htmls:
+        expected = expected_lines(html)
+        actual = list(html_chunks.iter_blocks(html, skip_tags))
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= args.show:
+                print(f"html:     {html!r}")
+                print(f"expected: {expected}")
+                print(f"actual:   {actual}")
+    print(f"docs={len(htmls)} mismatches={mismatches}")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""ベンチマーク用のS3とKibelaのインメモリ実装
+
+app.pyが使うboto3のクライアント/Bucketとgql_clientのメソッドだけを持つ。
+"""
+import datetime
+import hashlib
+import io
+
+import botocore.exceptions
+
+
+def client_error(code, operation):
+    return botocore.exceptions.ClientError(
+        {"Error": {"Code": code, "Message": code}}, operation
+    )
+
+
+class _Entry:
+    def __init__(self, body, metadata=None):
+        self.body = bytes(body)
+        self.metadata = dict(metadata or {})
+        self.etag = f'"{hashlib.md5(self.body).hexdigest()}"'
+        self.last_modified = datetime.datetime.now(datetime.timezone.utc)
+
+
+class FakeS3:
+    """バケット名 -> {キー: _Entry}"""
+
+    def __init__(self):
+        self.buckets = {}
+
+    def bucket(self, name):
+        return self.buckets.setdefault(name, {})
+
+    def get(self, bucket, key, operation="GetObject"):
+        entry = self.bucket(bucket).get(key)
+        if entry is None:
+            raise client_error("NoSuchKey", operation)
+        return entry
+
+    def put(self, bucket, key, body, metadata=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        elif hasattr(body, "read"):
+            body = body.read()
+        entry = _Entry(body, metadata)
+        self.bucket(bucket)[key] = entry
+        return entry
+
+    def delete(self, bucket, key):
+        self.bucket(bucket).pop(key, None)
+
+    def total_bytes(self, bucket):
+        return sum(map(lambda x: len(x.body), self.bucket(bucket).values()))
+
+
+class FakeS3Client:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, Range=None):
+        entry = self.s3.get(Bucket, Key)
+        if IfNoneMatch is not None and IfNoneMatch == entry.etag:
+            raise client_error("304", "GetObject")
+        body = entry.body
+        if Range is not None:
+            start, end = map(int, Range[len("bytes=") :].split("-"))
+            body = body[start : end + 1]
+        return {
+            "Body": io.BytesIO(body),
+            "ETag": entry.etag,
+            "LastModified": entry.last_modified,
+            "Metadata": dict(entry.metadata),
+        }
+
+    def head_object(self, Bucket, Key):
+        try:
+            entry = self.s3.get(Bucket, Key, "HeadObject")
+        except botocore.exceptions.ClientError:
+            raise client_error("404", "HeadObject")
+        return {
+            "ETag": entry.etag,
+            "LastModified": entry.last_modified,
+            "Metadata": dict(entry.metadata),
+        }
+
+    def put_object(self, Bucket, Key, Body, Metadata=None):
+        return {"ETag": self.s3.put(Bucket, Key, Body, Metadata).etag}
+
+    def list_objects_v2(self, Bucket, Prefix="", MaxKeys=1000, ContinuationToken=None):
+        keys = sorted(filter(lambda k: k.startswith(Prefix), self.s3.bucket(Bucket)))
+        start = int(ContinuationToken or 0)
+        page = keys[start : start + MaxKeys]
+        ret = {
+            "Contents": [
+                {
+                    "Key": key,
+                    "Size": len(entry.body),
+                    "ETag": entry.etag,
+                    "LastModified": entry.last_modified,
+                }
+                for key, entry in map(lambda k: (k, self.s3.bucket(Bucket)[k]), page)
+            ],
+            "IsTruncated": start + MaxKeys < len(keys),
+        }
+        if ret["IsTruncated"]:
+            ret["NextContinuationToken"] = str(start + MaxKeys)
+        return ret
+
+
+class FakeObject:
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket_name = bucket
+        self.key = key
+
+    def get(self):
+        entry = self.s3.get(self.bucket_name, self.key)
+        return {"Body": io.BytesIO(entry.body), "ETag": entry.etag}
+
+    def delete(self):
+        self.s3.delete(self.bucket_name, self.key)
+
+    @property
+    def last_modified(self):
+        return self.s3.get(self.bucket_name, self.key, "HeadObject").last_modified
+
+
+class FakeBucket:
+    def __init__(self, s3, name):
+        self.s3 = s3
+        self.name = name
+
+    def Object(self, key):
+        return FakeObject(self.s3, self.name, key)
+
+    def put_object(self, Body, Key, Metadata=None):
+        self.s3.put(self.name, Key, Body, Metadata)
+        return self.Object(Key)
+
+    def upload_fileobj(self, Fileobj, Key, ExtraArgs=None):
+        self.s3.put(self.name, Key, Fileobj, (ExtraArgs or {}).get("Metadata"))
+
+    def delete_objects(self, Delete):
+        for obj in Delete["Objects"]:
+            self.s3.delete(self.name, obj["Key"])
+
+
+class FakeKibela:
+    """クエリの変数で note / エイリアスした note / notes のどれかを返す"""
+
+    def __init__(self, notes):
+        self.notes = dict((note["id"], note) for note in notes)
+        self.order = list(map(lambda x: x["id"], notes))
+
+    def execute(self, query, variable_values=None, allow_partial=False):
+        variables = variable_values or {}
+        if "id" in variables:
+            return {"note": self.notes.get(variables["id"])}
+        if "id0" in variables:
+            return dict(
+                (f"n{name[len('id') :]}", self.notes.get(id_))
+                for name, id_ in variables.items()
+            )
+        if "first" in variables:
+            start = int(variables.get("cursor") or 0)
+            end = start + variables["first"]
+            return {
+                "notes": {
+                    "nodes": [
+                        dict(
+                            (k, self.notes[id_][k])
+                            for k in ["id", "contentUpdatedAt", "isArchived"]
+                        )
+                        for id_ in self.order[start:end]
+                    ],
+                    "pageInfo": {
+                        "hasNextPage": end < len(self.order),
+                        "endCursor": str(end),
+                    },
+                }
+            }
+        raise ValueError(f"unsupported query: {variables}")
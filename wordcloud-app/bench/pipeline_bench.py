@@ -0,0 +1,242 @@
+"""TF → IDF → PNG のパイプラインのベンチマーク
+
+    python bench/pipeline_bench.py --notes 200 --font /fonts/GenJyuuGothic-Normal.ttf
+    python bench/pipeline_bench.py --fixtures ./corpus --json result.json
+
+KibelaとS3はインメモリの実装(fakes.py)に差し替え、合成した日本語HTML
+(--fixturesを指定したときはそのディレクトリの*.html)を記事として
+update_tf / compact_tf_shards / update_idf / update_tf_idf_png を順に実行する。
+TFはデプロイと同じく--shards個のシャードにまとめる(0ならtf/{id}.binのまま)。
+ステージごとにスループット、1回あたりのp50/p99、ピークRSSを出す。
+"""
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+os.environ.setdefault("S3_PUBLIC", "bench-public")
+os.environ.setdefault("S3_PRIVATE", "bench-private")
+os.environ.setdefault("SSM_KIBELA_TEAM", "/bench/kibela-team")
+os.environ.setdefault("SSM_KIBELA_TOKEN", "/bench/kibela-token")
+
+import app  # noqa: E402
+import fakes  # noqa: E402
+
+NOUNS = (
+    "会議 資料 設計 開発 運用 障害 対応 手順 環境 構成 検証 本番 監視 通知 "
+    "データベース サーバー インスタンス デプロイ リリース レビュー テスト "
+    "パフォーマンス キャッシュ ログ メトリクス アラート ダッシュボード "
+    "要件 仕様 議事録 振り返り 目標 課題 予算 採用 評価 研修 契約 請求"
+).split()
+PARTICLES = ["は", "が", "を", "に", "で", "と", "の", "から", "まで"]
+ENDINGS = ["します。", "しました。", "です。", "を確認する。", "について検討した。"]
+
+
+def make_sentence(rand):
+    words = []
+    for _ in range(rand.randint(3, 8)):
+        words.append(rand.choice(NOUNS))
+        words.append(rand.choice(PARTICLES))
+    return "".join(words[:-1]) + rand.choice(ENDINGS)
+
+
+def make_html(rand, paragraphs):
+    blocks = []
+    for i in range(paragraphs):
+        kind = rand.random()
+        if kind < 0.1:
+            blocks.append(f"<h2>{rand.choice(NOUNS)}{rand.choice(NOUNS)}</h2>")
+        elif kind < 0.2:
+            items = "".join(
+                f"<li>{make_sentence(rand)}</li>" for _ in range(rand.randint(2, 5))
+            )
+            blocks.append(f"<ul>{items}</ul>")
+        elif kind < 0.25:
+            code = f"SELECT * FROM notes WHERE id = {i};"
+            blocks.append(f"<pre><code>{code}</code></pre>")
+        elif kind < 0.3:
+            blocks.append(f"<blockquote>{make_sentence(rand)}</blockquote>")
+        else:
+            sentences = "".join(make_sentence(rand) for _ in range(rand.randint(1, 6)))
+            blocks.append(f"<p>{sentences}</p>")
+    return "\n".join(blocks)
+
+
+def make_notes(args):
+    rand = random.Random(args.seed)
+    if args.fixtures:
+        paths = sorted(glob.glob(os.path.join(args.fixtures, "*.html")))
+        htmls = [open(path, encoding="utf-8").read() for path in paths]
+    else:
+        htmls = [
+            make_html(rand, rand.randint(args.paragraphs // 2, args.paragraphs * 2))
+            for _ in range(args.notes)
+        ]
+    updated_at = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+    minute = datetime.timedelta(minutes=1)
+    return [
+        {
+            "id": f"Tm90ZS8{i:06}",
+            "title": f"ベンチマーク記事{i}",
+            "url": f"https://bench.kibe.la/notes/{i}",
+            "contentHtml": html,
+            "contentUpdatedAt": (updated_at + minute * i).isoformat(),
+            "isArchived": False,
+        }
+        for i, html in enumerate(htmls)
+    ]
+
+
+def install_fakes(notes):
+    s3 = fakes.FakeS3()
+    app.s3_client = fakes.FakeS3Client(s3)
+    app.public_bucket = fakes.FakeBucket(s3, app.public_bucket_name)
+    app.private_bucket = fakes.FakeBucket(s3, app.private_bucket_name)
+    app.gql_client = fakes.FakeKibela(notes)
+    return s3
+
+
+def reset_peak_rss():
+    # VmHWMを今のRSSに戻す(Linux 4.0以降)。使えなければプロセス全体のピークになる
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(times, p):
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * p))]
+
+
+def run_stage(name, fn, items, units):
+    """itemsごとにfnを呼んで時間を測る。unitsは処理した記事数"""
+    reset_peak_rss()
+    times = []
+    start = time.perf_counter()
+    for item in items:
+        t = time.perf_counter()
+        fn(item)
+        times.append(time.perf_counter() - t)
+    total = time.perf_counter() - start
+    result = {
+        "stage": name,
+        "calls": len(times),
+        "notes": units,
+        "total_s": total,
+        "throughput": units / total if total > 0 else 0.0,
+        "mean_ms": statistics.mean(times) * 1000,
+        "p50_ms": statistics.median(times) * 1000,
+        "p99_ms": percentile(times, 0.99) * 1000,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print(
+        f"{name:12s} calls={result['calls']} notes={units} "
+        f"throughput={result['throughput']:.1f} notes/s "
+        f"p50={result['p50_ms']:.1f}ms p99={result['p99_ms']:.1f}ms "
+        f"peak_rss={result['peak_rss_mb']:.1f}MB"
+    )
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notes", type=int, default=100)
+    parser.add_argument("--paragraphs", type=int, default=20)
+    parser.add_argument("--fixtures", help="*.htmlを記事として使うディレクトリ")
+    parser.add_argument("--font", default=app.wc_config["font_path"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--stages",
+        default="tf,tf_batch,compact,idf,idf_rebuild,png,png_batch",
+        help="カンマ区切りで実行するステージ",
+    )
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--shards", type=int, default=16, help="TF_SHARDS")
+    parser.add_argument("--json", help="結果をJSONで書き出すファイル")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        app.logger.setLevel(logging.WARNING)
+    app.wc_config["font_path"] = args.font
+    app.tf_shard_count = args.shards
+
+    notes = make_notes(args)
+    ids = list(map(lambda x: x["id"], notes))
+    batches = [
+        ids[i : i + args.batch_size] for i in range(0, len(ids), args.batch_size)
+    ]
+    s3 = install_fakes(notes)
+    chars = sum(map(lambda x: len(x["contentHtml"]), notes))
+    print(
+        f"notes={len(notes)} html={chars / 1024:.0f}KB shards={args.shards} "
+        f"stages={args.stages}"
+    )
+
+    # 前のステージの出力を次のステージが読む
+    stages = {
+        "tf": lambda: run_stage(
+            "tf", lambda id_: app.update_tf(id_, incremental=True), ids, len(ids)
+        ),
+        "tf_batch": lambda: run_stage(
+            "tf_batch", app.update_tf_batch, batches, len(ids)
+        ),
+        "compact": lambda: run_stage(
+            "compact", lambda _: app.compact_tf_shards(), [None], len(ids)
+        ),
+        "idf": lambda: run_stage("idf", lambda _: app.update_idf(), [None], len(ids)),
+        "idf_rebuild": lambda: run_stage(
+            "idf_rebuild", lambda _: app.update_idf(rebuild=True), [None], len(ids)
+        ),
+        "png": lambda: run_stage("png", app.update_tf_idf_png, ids, len(ids)),
+        "png_batch": lambda: run_stage(
+            "png_batch", app.update_tf_idf_png_batch, batches, len(ids)
+        ),
+    }
+    results = []
+    for name in args.stages.split(","):
+        if name not in stages:
+            parser.error(f"unknown stage: {name}")
+        if name.startswith("png"):
+            # 前のステージのPNGがあると変更なしとして描画を飛ばすので消しておく
+            s3.bucket(app.public_bucket_name).clear()
+        results.append(stages[name]())
+    print(
+        f"s3 private={s3.total_bytes(app.private_bucket_name) / 1024:.0f}KB "
+        f"public={s3.total_bytes(app.public_bucket_name) / 1024:.0f}KB"
+    )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"args": vars(args), "notes": len(notes), "results": results},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""WordCloud描画のベンチマーク
+
+    python bench/render_bench.py --font /fonts/GenJyuuGothic-Normal.ttf
+
+ランダムな頻度辞書を作り、画像ごとにWordCloudを作る従来の方法と
+WordCloudRendererの1枚あたりの描画時間を比べる。
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from wordcloud import WordCloud  # noqa: E402
+
+from wordcloud_renderer import WordCloudRenderer  # noqa: E402
+
+
+def make_corpus(num_notes, num_words, seed):
+    rand = random.Random(seed)
+    chars = "アイウエオカキクケコサシスセソタチツテトナニヌネノ会議資料設計開発運用"
+    vocab = [
+        "".join(rand.choice(chars) for _ in range(rand.randint(2, 6)))
+        for _ in range(num_words * 10)
+    ]
+    return [
+        dict((word, rand.random()) for word in rand.sample(vocab, num_words))
+        for _ in range(num_notes)
+    ]
+
+
+def measure(render, corpus):
+    times = []
+    for freq in corpus:
+        start = time.perf_counter()
+        render(freq)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def report(name, times):
+    times = sorted(times)
+    p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+    print(
+        f"{name:10s} n={len(times)} mean={statistics.mean(times) * 1000:.1f}ms "
+        f"p50={statistics.median(times) * 1000:.1f}ms p99={p99 * 1000:.1f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--font", default="/fonts/GenJyuuGothic-Normal.ttf")
+    parser.add_argument("--notes", type=int, default=50)
+    parser.add_argument("--words", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = dict(
+        font_path=args.font,
+        min_font_size=12,
+        max_font_size=40,
+        width=300,
+        height=120,
+        mode="RGBA",
+        background_color=(0, 0, 0, 0),
+        colormap="Dark2",
+        random_state=args.seed,
+    )
+    corpus = make_corpus(args.notes, args.words, args.seed)
+
+    def render_before(freq):
+        wc = WordCloud(**config)
+        wc.generate_from_frequencies(freq)
+        wc.to_image()
+
+    report("before", measure(render_before, corpus))
+    renderer = WordCloudRenderer(config)
+    report("after", measure(renderer.render, corpus))
+
+
+if __name__ == "__main__":
+    main()